@@ -0,0 +1,124 @@
+# Throughput and latency of the API under concurrent load, driven in-process through ASGI so no
+# server or network is involved. Runs against a fresh database in a scratch directory, seeded with
+# the test assets plus a synthetic user base, and prints JSON to compare run to run:
+#   python benchmarks/load_benchmark.py --users 10000 --streams 8 --frames 50 --searchers 4
+# Settings are read from the same environment variables as the server (INFERENCE_WORKERS,
+# SESSION_BACKEND, DETECTOR_SESSIONS, ...).
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from report import latency_summary, peak_rss_mb, video_frames
+from search_benchmark import synthetic_embeddings
+
+ASSETS = os.path.join(ROOT, 'test_assets')
+
+def read_asset(name):
+    with open(os.path.join(ASSETS, name), 'rb') as f:
+        return f.read()
+
+async def enroll(client, main, n_users):
+    # The real users go through PUT /users so they are encoded like production enrollments
+    for user_id, name in ((1, 'test-4.jpg'), (2, 'test-10.jpg')):
+        response = await client.put(f'/users/{user_id}', files={'file': (name, read_asset(name), 'image/jpeg')})
+        response.raise_for_status()
+    if n_users == 0:
+        return
+    # Synthetic users are written straight to the database and search index
+    gallery, _ = synthetic_embeddings(n_users, 0)
+    for start in range(0, n_users, 5000):
+        main.write_enrollments([(1000 + i, gallery[i]) for i in range(start, min(start + 5000, n_users))])
+
+async def session_stream(client, stream, user_id, frames, count, latencies, failures):
+    for i in range(count):
+        start = time.perf_counter()
+        response = await client.post(f'/sessions?session_id=bench-{stream}&user_id={user_id}&timestamp={i}',
+                                     files={'file': ('frame.jpg', frames[(stream + i) % len(frames)], 'image/jpeg')})
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200 or response.json() != 'Image received':
+            failures.append(response.status_code)
+
+async def searcher(client, worker, images, count, latencies, failures):
+    for i in range(count):
+        start = time.perf_counter()
+        response = await client.post('/users/search',
+                                     files={'file': ('query.jpg', images[(worker + i) % len(images)], 'image/jpeg')})
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            failures.append(response.status_code)
+
+async def scenario(name, make_workers):
+    latencies, failures = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*make_workers(latencies, failures))
+    elapsed = time.perf_counter() - start
+    summary = latency_summary(latencies, elapsed)
+    summary.update({'scenario': name, 'elapsed_seconds': elapsed, 'failures': len(failures),
+                    'failure_statuses': sorted(set(failures))})
+    summary['requests_per_second'] = summary.pop('per_second')
+    return summary
+
+async def run(args, main):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+        start = time.perf_counter()
+        await enroll(client, main, args.users)
+        seed_seconds = time.perf_counter() - start
+
+        frames = [read_asset('test-4.jpg'), read_asset('test-10.jpg')]
+        frames += video_frames(os.path.join(ASSETS, 'test-2.mp4'), args.video_stride)
+        results = []
+        if args.streams and args.frames:
+            results.append(await scenario('sessions', lambda latencies, failures: [
+                session_stream(client, stream, 1 + stream % 2, frames, args.frames, latencies, failures)
+                for stream in range(args.streams)]))
+        if args.searchers and args.searches:
+            results.append(await scenario('search', lambda latencies, failures: [
+                searcher(client, worker, frames, args.searches, latencies, failures)
+                for worker in range(args.searchers)]))
+    return seed_seconds, results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000, help='synthetic users added to the gallery')
+    parser.add_argument('--streams', type=int, default=8, help='concurrent session streams')
+    parser.add_argument('--frames', type=int, default=50, help='frames posted by each session stream')
+    parser.add_argument('--searchers', type=int, default=4, help='concurrent /users/search clients')
+    parser.add_argument('--searches', type=int, default=25, help='searches made by each client')
+    parser.add_argument('--video-stride', type=int, default=10)
+    parser.add_argument('--digest-cache', action='store_true',
+                        help='keep the upload digest cache on; off by default since the inputs repeat')
+    args = parser.parse_args()
+
+    if not args.digest_cache:
+        os.environ.setdefault('DIGEST_CACHE_MEMORY_BYTES', '0')
+        os.environ.setdefault('DIGEST_CACHE_DISK_BYTES', '0')
+    # main.py keeps its database and caches relative to the working directory
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        import main as app_module
+        try:
+            seed_seconds, results = asyncio.run(run(args, app_module))
+        finally:
+            app_module.app.inference.shutdown()
+            app_module.app.sessions.flush()
+        os.chdir(ROOT)
+
+    print(json.dumps({
+        'users': args.users + 2,
+        'inference_workers': app_module.inference_workers,
+        'seed_seconds': seed_seconds,
+        'scenarios': results,
+        'peak_rss_mb': peak_rss_mb(),
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Per-frame latency and accuracy of detector pre-processing options against the original
+# full-resolution HOG path, on the frames of test_assets/test-2.mp4 scored against test-10.jpg:
+#   python benchmarks/preprocess_benchmark.py
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from preprocess import bounding_box, decode, detect, encode, parse_detector_config
+from report import video_frames
+
+CONFIGS = [
+    '',
+    'decode_scale=2',
+    'decode_scale=4',
+    'detector_width=320',
+    'roi_margin=0.5',
+    'decode_scale=2,roi_margin=0.5',
+    'model=cnn',
+    'num_jitters=5',
+]
+
+def run(config, frames, baseline):
+    roi = None
+    distances, latencies = [], []
+    for file in frames:
+        start = time.perf_counter()
+        image = decode(file, config)
+        locations = detect(image, config, roi)
+        embeddings = encode(image, locations, config)
+        latencies.append(time.perf_counter() - start)
+        roi = bounding_box(locations)
+        distances.append(min([np.linalg.norm(baseline - e) / 2 for e in embeddings], default=1.0))
+    return np.array(distances), np.array(latencies)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video', default=os.path.join(ROOT, 'test_assets', 'test-2.mp4'))
+    parser.add_argument('--reference', default=os.path.join(ROOT, 'test_assets', 'test-10.jpg'))
+    parser.add_argument('--stride', type=int, default=10)
+    parser.add_argument('--configs', nargs='*', default=CONFIGS)
+    args = parser.parse_args()
+
+    frames = list(video_frames(args.video, args.stride))
+    with open(args.reference, 'rb') as f:
+        reference = f.read()
+    default = parse_detector_config('')
+    image = decode(reference, default)
+    baseline = encode(image, detect(image, default), default)[0]
+
+    results = []
+    baseline_distances = None
+    for spec in args.configs:
+        config = parse_detector_config(spec)
+        distances, latencies = run(config, frames, baseline)
+        if baseline_distances is None:
+            baseline_distances = distances
+        results.append({
+            'config': spec or 'default',
+            'frames': len(frames),
+            'p50_ms': float(np.percentile(latencies, 50) * 1000),
+            'p95_ms': float(np.percentile(latencies, 95) * 1000),
+            'mean_distance': float(distances.mean()),
+            'max_abs_distance_delta': float(np.abs(distances - baseline_distances).max()),
+            'faces_missed': int(np.count_nonzero(distances == 1.0)),
+        })
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
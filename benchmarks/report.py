@@ -0,0 +1,35 @@
+# Shared helpers so every benchmark reads its inputs and reports latency and memory the same way
+import resource
+import sys
+
+import cv2
+import numpy as np
+
+def video_frames(path, stride):
+    # Re-encode every stride-th frame as a JPEG, the way a webcam client uploads them
+    cap = cv2.VideoCapture(path)
+    frame_count = 0
+    while cap.isOpened():
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frame_count += 1
+        if frame_count % stride == 0:
+            yield cv2.imencode('.jpg', frame)[1].tobytes()
+
+def latency_summary(latencies, elapsed=None):
+    # latencies in seconds; elapsed is the wall time the requests were spread over
+    latencies = np.asarray(latencies, dtype=np.float64)
+    summary = {'count': int(len(latencies))}
+    if len(latencies):
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        summary.update({'mean_ms': float(latencies.mean() * 1000), 'p50_ms': float(p50),
+                        'p95_ms': float(p95), 'p99_ms': float(p99)})
+    if elapsed:
+        summary['per_second'] = len(latencies) / elapsed
+    return summary
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
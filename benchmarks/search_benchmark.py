@@ -0,0 +1,107 @@
+# Recall, latency and (for the quantized gallery) distance error of the /users/search backends on
+# synthetic 128-d embeddings:
+#   python benchmarks/search_benchmark.py --users 100000 --queries 200
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gallery import QuantizedGallery
+from search import ChromaSearch, ExactSearch, IVFSearch
+
+def synthetic_embeddings(n_users, n_queries, seed=0):
+    # Face embeddings cluster by appearance, so draw users around a set of cluster centres and
+    # query with noisy copies of enrolled users (a re-photographed face)
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(0, 0.15, size=(max(1, n_users // 100), 128))
+    gallery = (centres[rng.integers(len(centres), size=n_users)]
+               + rng.normal(0, 0.05, size=(n_users, 128))).astype(np.float32)
+    targets = rng.integers(n_users, size=n_queries)
+    queries = (gallery[targets] + rng.normal(0, 0.02, size=(n_queries, 128))).astype(np.float32)
+    return gallery, queries
+
+def timed_search(backend, queries, k, with_distances=False):
+    start = time.perf_counter()
+    results = [backend.search(query[None, :], k) for query in queries]
+    latency = (time.perf_counter() - start) / len(queries)
+    ids = [found[0] for found, _ in results]
+    if with_distances:
+        return ids, latency, [np.asarray(distances[0]) for _, distances in results]
+    return ids, latency
+
+def recall(ids, truth):
+    return float(np.mean([len(set(found) & set(expected)) / len(expected) for found, expected in zip(ids, truth)]))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--n-probe', type=int, nargs='*', default=[1, 4, 16, 64])
+    parser.add_argument('--skip-chroma', action='store_true')
+    args = parser.parse_args()
+
+    gallery, queries = synthetic_embeddings(args.users, args.queries)
+    ids = [str(i) for i in range(args.users)]
+    results = []
+
+    exact = ExactSearch()
+    exact.add(ids, gallery)
+    truth, latency, truth_distances = timed_search(exact, queries, args.k, with_distances=True)
+    results.append({'backend': 'exact', 'recall': 1.0, 'latency_ms': latency * 1000})
+    start = time.perf_counter()
+    exact.search(queries, args.k)
+    results.append({'backend': 'exact-batched', 'recall': 1.0,
+                    'latency_ms': (time.perf_counter() - start) / len(queries) * 1000})
+
+    ivf = IVFSearch(min_train_size=0)
+    ivf.add(ids, gallery)
+    start = time.perf_counter()
+    ivf.build_lists()
+    build_seconds = time.perf_counter() - start
+    for n_probe in args.n_probe:
+        ivf.n_probe = n_probe
+        found, latency = timed_search(ivf, queries, args.k)
+        results.append({'backend': f'ivf-nprobe-{n_probe}', 'recall': recall(found, truth),
+                        'latency_ms': latency * 1000, 'build_seconds': build_seconds})
+
+    # Accuracy delta of the quantized formats against float32: recall of the exact top-k, and how far
+    # the reported distance of each user found moves
+    for dtype in ('float16', 'int8'):
+        with tempfile.TemporaryDirectory() as directory:
+            quantized = QuantizedGallery(directory, dtype)
+            start = time.perf_counter()
+            quantized.add(ids, gallery)
+            build_seconds = time.perf_counter() - start
+            found, latency, distances = timed_search(quantized, queries, args.k, with_distances=True)
+            exact_distances = [dict(zip(expected, expected_distances))
+                               for expected, expected_distances in zip(truth, truth_distances)]
+            deltas = np.array([abs(distance - expected[user_id])
+                               for query_ids, query_distances, expected in zip(found, distances, exact_distances)
+                               for user_id, distance in zip(query_ids, query_distances) if user_id in expected])
+            results.append({'backend': f'quantized-{dtype}', 'recall': recall(found, truth),
+                            'latency_ms': latency * 1000, 'build_seconds': build_seconds,
+                            'bytes_per_user': quantized.vectors.itemsize * 128 + 17,
+                            'mean_distance_delta': float(deltas.mean()) if len(deltas) else None,
+                            'max_distance_delta': float(deltas.max()) if len(deltas) else None})
+
+    if not args.skip_chroma:
+        import chromadb
+        collection = chromadb.EphemeralClient().create_collection(name='search_benchmark')
+        start = time.perf_counter()
+        for offset in range(0, args.users, 5000):
+            collection.add(ids=ids[offset:offset + 5000], embeddings=gallery[offset:offset + 5000].tolist())
+        build_seconds = time.perf_counter() - start
+        found, latency = timed_search(ChromaSearch(collection), queries, args.k)
+        results.append({'backend': 'chroma', 'recall': recall(found, truth),
+                        'latency_ms': latency * 1000, 'build_seconds': build_seconds})
+
+    print(json.dumps({'users': args.users, 'queries': args.queries, 'k': args.k, 'results': results}, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Latency of each stage of the request path in isolation, on the test assets and a synthetic
+# chroma gallery, as JSON to compare run to run:
+#   python benchmarks/stage_benchmark.py --users 10000 --repeat 50
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import chromadb
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from preprocess import decode, detect, encode, parse_detector_config
+from report import latency_summary, peak_rss_mb
+from search_benchmark import synthetic_embeddings
+
+def time_calls(fn, repeat):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def seed_collection(collection, gallery, batch_size=5000):
+    for start in range(0, len(gallery), batch_size):
+        batch = gallery[start:start + batch_size]
+        collection.add(ids=[str(i) for i in range(start, start + len(batch))], embeddings=batch.tolist())
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', nargs='*', default=[os.path.join(ROOT, 'test_assets', name)
+                                                       for name in ('test-4.jpg', 'test-10.jpg')])
+    parser.add_argument('--config', default='', help='DETECTOR_* style detector settings')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    config = parse_detector_config(args.config)
+    results = {'config': args.config or 'default', 'users': args.users, 'stages': {}}
+    stages = results['stages']
+
+    for path in args.images:
+        name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            file = f.read()
+        image = decode(file, config)
+        locations = detect(image, config)
+        embeddings = encode(image, locations, config)
+        stages[f'decode[{name}]'] = latency_summary(time_calls(lambda: decode(file, config), args.repeat))
+        stages[f'detect[{name}]'] = latency_summary(time_calls(lambda: detect(image, config), args.repeat))
+        stages[f'encode[{name}]'] = latency_summary(time_calls(lambda: encode(image, locations, config), args.repeat))
+        baseline = np.asarray(embeddings[0], dtype=np.float32)
+        stages[f'distance[{name}]'] = latency_summary(time_calls(
+            lambda: np.linalg.norm(np.array([baseline]) - embeddings[0], axis=1).item() / 2, args.repeat))
+
+    gallery, queries = synthetic_embeddings(args.users, args.repeat)
+    with tempfile.TemporaryDirectory() as directory:
+        collection = chromadb.PersistentClient(path=directory).get_or_create_collection(name='user_embeddings')
+        start = time.perf_counter()
+        seed_collection(collection, gallery)
+        results['chroma_seed_seconds'] = time.perf_counter() - start
+        rng = np.random.default_rng(1)
+        stages['chroma_get'] = latency_summary(time_calls(
+            lambda: collection.get(ids=[str(rng.integers(args.users))], include=['embeddings']), args.repeat))
+        query_iter = iter(queries)
+        stages['chroma_query'] = latency_summary(time_calls(
+            lambda: collection.query(query_embeddings=[next(query_iter).tolist()], n_results=1,
+                                     include=['distances']), args.repeat))
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
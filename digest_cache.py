@@ -0,0 +1,150 @@
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import threading
+import zipfile
+
+import numpy as np
+
+from metrics import Counter
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Face boxes and encodings of recently seen uploads, keyed by a hash of the raw bytes
+digest_cache_memory_bytes = int(os.environ.get('DIGEST_CACHE_MEMORY_BYTES', 64 * 1024 * 1024))
+# Second tier on local disk, e.g. 1073741824 for 1 GiB; off (0) unless set
+digest_cache_disk_bytes = int(os.environ.get('DIGEST_CACHE_DISK_BYTES', 0))
+digest_cache_dir = os.environ.get('DIGEST_CACHE_DIR', 'digest_cache')
+
+digest_cache_memory_hits = Counter('digest_cache_memory_hits_total', 'Uploads whose faces were found in the memory cache')
+digest_cache_disk_hits = Counter('digest_cache_disk_hits_total', 'Uploads whose faces were found in the disk cache')
+digest_cache_misses = Counter('digest_cache_misses_total', 'Uploads that had to be decoded and encoded')
+
+def upload_digest(file, config):
+    # The detector settings are part of the key since they change the result
+    suffix = repr(tuple(config)).encode()
+    if xxhash is not None:
+        return xxhash.xxh3_128_hexdigest(file) + xxhash.xxh3_64_hexdigest(suffix)
+    return hashlib.blake2b(file + suffix, digest_size=20).hexdigest()
+
+def entry_size(locations, encodings):
+    return 128 + 32 * len(locations) + sum(encoding.nbytes for encoding in encodings)
+
+class DigestCache:
+    # The memory tier is only touched from the event loop. The disk tier's get_disk and put_disk
+    # do file I/O, so callers on the event loop run them in a worker thread; they never touch the
+    # memory tier and are safe to call from several threads.
+    def __init__(self, memory_bytes=digest_cache_memory_bytes, disk_bytes=digest_cache_disk_bytes,
+                 directory=digest_cache_dir):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.directory = directory
+        # key -> (locations, encodings, size), least recently used first
+        self.entries = OrderedDict()
+        self.memory_used = 0
+        self.disk_used = 0
+        self.disk_lock = threading.Lock()
+        if disk_bytes > 0:
+            os.makedirs(directory, exist_ok=True)
+            self.disk_used = sum(entry.stat().st_size for entry in self.disk_entries())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        found = self.get_memory(key)
+        if found is None and self.disk_bytes > 0:
+            found = self.get_disk(key)
+            if found is not None:
+                self.remember(key, *found)
+        return found
+
+    def get_memory(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            if self.disk_bytes <= 0:
+                digest_cache_misses.inc()
+            return None
+        self.entries.move_to_end(key)
+        digest_cache_memory_hits.inc()
+        return entry[0], entry[1]
+
+    def get_disk(self, key):
+        # The caller remembers a hit in the memory tier
+        path = self.path(key)
+        try:
+            with np.load(path) as stored:
+                locations = [tuple(int(v) for v in box) for box in stored['locations']]
+                encodings = list(stored['encodings'])
+            # Touch it so disk eviction is least recently used too
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # Unreadable, e.g. left torn by a crash before writes were atomic, so drop it
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        else:
+            digest_cache_disk_hits.inc()
+            return locations, encodings
+        digest_cache_misses.inc()
+        return None
+
+    def put(self, key, locations, encodings):
+        self.remember(key, locations, encodings)
+        if self.disk_bytes > 0:
+            self.put_disk(key, locations, encodings)
+
+    def put_disk(self, key, locations, encodings):
+        path = self.path(key)
+        # Written aside and renamed into place, so a reader in another worker (or after a
+        # crash) never sees a partial file
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, locations=np.array(locations, dtype=np.int64).reshape(-1, 4),
+                         encodings=np.array(encodings, dtype=np.float64).reshape(-1, 128))
+            os.replace(temp, path)
+        except BaseException:
+            os.remove(temp)
+            raise
+        with self.disk_lock:
+            self.disk_used += os.path.getsize(path)
+            if self.disk_used > self.disk_bytes:
+                self.evict_disk()
+
+    def remember(self, key, locations, encodings):
+        size = entry_size(locations, encodings)
+        if key in self.entries:
+            self.memory_used -= self.entries.pop(key)[2]
+        self.entries[key] = (locations, encodings, size)
+        self.memory_used += size
+        while self.memory_used > self.memory_bytes and self.entries:
+            self.memory_used -= self.entries.popitem(last=False)[1][2]
+
+    def disk_entries(self):
+        # Finished entries only: .tmp files may still be being written by another worker
+        return [entry for entry in os.scandir(self.directory) if entry.is_file() and entry.name.endswith('.npz')]
+
+    def evict_disk(self):
+        # Drop the least recently used files until we're 10% under the bound, so this scan is rare
+        files = sorted(self.disk_entries(), key=lambda entry: entry.stat().st_mtime)
+        self.disk_used = sum(entry.stat().st_size for entry in files)
+        for entry in files:
+            if self.disk_used <= 0.9 * self.disk_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.disk_used -= size
+            except OSError:
+                pass
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
@@ -0,0 +1,89 @@
+from collections import OrderedDict
+import os
+import time
+
+import numpy as np
+
+from metrics import Counter, Gauge
+
+embedding_dim = 128
+# Maximum number of user embeddings held in memory before the least recently used is evicted
+embedding_store_size = int(os.environ.get('EMBEDDING_STORE_SIZE', 100000))
+# Seconds a cached embedding is served before being re-read from the database. Writes only
+# invalidate the worker that served them, so this bounds how long other workers see a deleted or
+# re-enrolled user's old embedding; 0 keeps entries until evicted (fine with a single worker)
+embedding_store_ttl = float(os.environ.get('EMBEDDING_STORE_TTL', 60))
+
+embedding_store_hits = Counter('embedding_store_hits_total', 'Baseline embedding lookups served from memory')
+embedding_store_misses = Counter('embedding_store_misses_total', 'Baseline embedding lookups read from the database')
+
+class EmbeddingStore:
+    # Read-through cache of user embeddings kept as rows of one contiguous float32 matrix
+    def __init__(self, loader, max_users=embedding_store_size, ttl=embedding_store_ttl):
+        self.loader = loader
+        self.max_users = max_users
+        self.ttl = ttl
+        self.matrix = np.zeros((min(max_users, 1024), embedding_dim), dtype=np.float32)
+        # When each row was loaded, on the monotonic clock
+        self.loaded_at = np.zeros(len(self.matrix))
+        # user_id -> matrix row, least recently used first
+        self.rows = OrderedDict()
+        self.free_rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, user_id):
+        return user_id in self.rows
+
+    def get(self, user_id):
+        row = self.rows.get(user_id)
+        if row is not None and (self.ttl <= 0 or time.monotonic() - self.loaded_at[row] <= self.ttl):
+            self.rows.move_to_end(user_id)
+            embedding_store_hits.inc()
+            return self.matrix[row].copy()
+        embedding_store_misses.inc()
+        embedding = self.loader(user_id)
+        if embedding is None:
+            # Deleted by another worker since it was cached
+            self.delete(user_id)
+            return None
+        # put() may grow the matrix, so index it only afterwards
+        row = self.put(user_id, embedding)
+        return self.matrix[row].copy()
+
+    def put(self, user_id, embedding):
+        row = self.rows.get(user_id)
+        if row is None:
+            row = self.allocate_row()
+        self.matrix[row] = embedding
+        self.loaded_at[row] = time.monotonic()
+        self.rows[user_id] = row
+        self.rows.move_to_end(user_id)
+        return row
+
+    def delete(self, user_id):
+        row = self.rows.pop(user_id, None)
+        if row is not None:
+            self.free_rows.append(row)
+
+    def allocate_row(self):
+        if self.free_rows:
+            return self.free_rows.pop()
+        if len(self.rows) < len(self.matrix):
+            return len(self.rows)
+        if len(self.matrix) < self.max_users:
+            # Grow geometrically up to the configured bound
+            grown = np.zeros((min(self.max_users, 2 * len(self.matrix)), embedding_dim), dtype=np.float32)
+            grown[:len(self.matrix)] = self.matrix
+            loaded_at = np.zeros(len(grown))
+            loaded_at[:len(self.matrix)] = self.loaded_at
+            row = len(self.matrix)
+            self.matrix, self.loaded_at = grown, loaded_at
+            return row
+        # Full, so reuse the least recently used user's row
+        _, row = self.rows.popitem(last=False)
+        return row
+
+def register_metrics(store):
+    Gauge('embedding_store_users', 'User embeddings held in memory', lambda: len(store))
@@ -0,0 +1,117 @@
+import base64
+import json
+import os
+import re
+import tarfile
+import time
+import zipfile
+
+# Embeddings are written to the database in upserts of this many users
+bulk_batch_size = int(os.environ.get('BULK_BATCH_SIZE', 1000))
+# A progress line is streamed back at most this often
+bulk_progress_interval = float(os.environ.get('BULK_PROGRESS_INTERVAL', 5))
+# Journals of completed users, so an interrupted job can be resumed with the same job_id
+bulk_jobs_dir = os.environ.get('BULK_JOBS_DIR', 'bulk_jobs')
+# Job ids name files in bulk_jobs_dir, so they are kept to a safe alphabet
+job_id_pattern = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+# Same rules and messages as PUT /users/{user_id}
+enrolled_message = 'User image embedding successfully added to the database'
+no_face_message = 'No face found in the photo'
+many_faces_message = 'More than one face found in the photo'
+
+def face_count_message(face_count):
+    if face_count == 1:
+        return enrolled_message
+    elif face_count == 0:
+        return no_face_message
+    else:
+        return many_faces_message
+
+def parse_user_id(name):
+    # Archive members are named <user_id>.jpg, possibly inside a directory
+    stem = os.path.splitext(os.path.basename(name))[0]
+    return int(stem) if stem.isdigit() else None
+
+def iter_archive(fileobj):
+    # Yield (user_id, image bytes) for each image in a zip or tar archive, one member at a time
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    yield parse_user_id(info.filename), info.filename, archive.read(info)
+        return
+    fileobj.seek(0)
+    with tarfile.open(fileobj=fileobj, mode='r:*') as archive:
+        for member in archive:
+            if member.isfile():
+                yield parse_user_id(member.name), member.name, archive.extractfile(member).read()
+
+def parse_manifest_line(line):
+    # NDJSON manifest lines look like {"user_id": 104, "image": "<base64 JPEG>"}
+    entry = json.loads(line)
+    return int(entry['user_id']), str(entry['user_id']), base64.b64decode(entry['image'])
+
+def iter_manifest(fileobj):
+    # Yield (user_id, name, image bytes) for each line of an NDJSON manifest; a line that can't be
+    # parsed yields (None, line number, None) so the rest of the manifest is still enrolled
+    for number, line in enumerate(fileobj, 1):
+        if not line.strip():
+            continue
+        try:
+            yield parse_manifest_line(line)
+        except (ValueError, KeyError, TypeError):
+            yield None, number, None
+
+class EnrollmentJournal:
+    # Append-only record of users whose outcome is final (written to the database or rejected)
+    def __init__(self, job_id, directory=None):
+        if not job_id_pattern.fullmatch(job_id):
+            raise ValueError(f'Invalid job id {job_id!r}')
+        directory = directory or bulk_jobs_dir
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f'{job_id}.ndjson')
+        self.done = set()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line)['user_id'])
+                    except (ValueError, KeyError):
+                        # A torn last line from a crash just means that user is redone
+                        pass
+        self.file = open(self.path, 'a')
+
+    def record(self, statuses):
+        for status in statuses:
+            self.file.write(json.dumps(status) + '\n')
+            self.done.add(status['user_id'])
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+class EnrollmentProgress:
+    def __init__(self, resumed):
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.processed = 0
+        self.enrolled = 0
+        self.rejected = 0
+        self.resumed = resumed
+
+    def due(self):
+        return time.perf_counter() - self.last_report >= bulk_progress_interval
+
+    def report(self):
+        self.last_report = time.perf_counter()
+        elapsed = self.last_report - self.start
+        return {'progress': {
+            'processed': self.processed,
+            'enrolled': self.enrolled,
+            'rejected': self.rejected,
+            'resumed': self.resumed,
+            'users_per_second': self.processed / elapsed if elapsed > 0 else 0.0,
+        }}
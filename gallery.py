@@ -0,0 +1,309 @@
+from contextlib import contextmanager
+import fcntl
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from embedding_store import embedding_dim
+from search import search_block_size, top_k
+
+# Directory holding the quantized gallery used by SEARCH_BACKEND=quantized
+gallery_path = os.environ.get('GALLERY_PATH', os.path.join('chroma', 'gallery'))
+# 'int8' (a quarter of float32, one scale per vector) or 'float16' (half of float32)
+gallery_dtype = os.environ.get('GALLERY_DTYPE', 'int8')
+# Compact once this fraction of the written rows are tombstones
+gallery_compact_ratio = float(os.environ.get('GALLERY_COMPACT_RATIO', 0.25))
+
+# Row states; rows past the last written one are still EMPTY since files are preallocated
+EMPTY, LIVE, DELETED = 0, 1, 2
+
+def quantize(embeddings, dtype):
+    # Returns (vectors, scales) with embeddings ~= vectors * scales[:, None]
+    embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, embedding_dim)
+    if dtype == 'float16':
+        return embeddings.astype(np.float16), np.ones(len(embeddings), dtype=np.float32)
+    scales = np.abs(embeddings).max(axis=1) / 127
+    scales[scales == 0] = 1
+    vectors = np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8)
+    return vectors, scales.astype(np.float32)
+
+def dequantize(vectors, scales):
+    return vectors.astype(np.float32) * scales[:, None]
+
+class QuantizedGallery:
+    # Columnar, memory-mapped gallery of quantized embeddings. Each generation directory holds one
+    # preallocated file per column (ids, row states, scales, squared norms and vectors), so
+    # startup maps the files instead of reading them. Writes only append rows or flip a row's
+    # state to DELETED; compaction rewrites the live rows into a new generation in a background
+    # thread and switches CURRENT to it atomically.
+    # Every worker process opens the same directory. Writers (adds, removes and compaction) hold an
+    # exclusive lock on the LOCK file and first catch up with rows other processes appended;
+    # readers catch up the same way before each search, so every process sees every write.
+    columns = {'ids': np.int64, 'states': np.uint8, 'scales': np.float32, 'norms': np.float32}
+
+    def __init__(self, path=gallery_path, dtype=gallery_dtype, compact_ratio=gallery_compact_ratio):
+        if dtype not in ('int8', 'float16'):
+            raise ValueError(f'Unknown gallery dtype {dtype}')
+        self.path = path
+        self.dtype = dtype
+        self.compact_ratio = compact_ratio
+        # Guards this instance's maps and index; always taken after the writer locks
+        self.lock = threading.Lock()
+        # Writers in this process, then writers in every process
+        self.write_lock = threading.Lock()
+        self.compacting = False
+        os.makedirs(path, exist_ok=True)
+        self.lock_fd = os.open(os.path.join(path, 'LOCK'), os.O_RDWR | os.O_CREAT)
+        with self.writing():
+            self.generation = self.read_current()
+            if self.generation is None:
+                self.generation = 0
+                self.write_current()
+            self.open(self.generation_dir(self.generation))
+
+    @contextmanager
+    def writing(self):
+        with self.write_lock:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def read_current(self):
+        try:
+            with open(os.path.join(self.path, 'CURRENT')) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return None
+
+    def generation_dir(self, generation):
+        return os.path.join(self.path, f'gen-{generation:06d}')
+
+    def write_current(self):
+        temp = os.path.join(self.path, 'CURRENT.tmp')
+        with open(temp, 'w') as f:
+            f.write(str(self.generation))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, os.path.join(self.path, 'CURRENT'))
+
+    def open(self, directory, capacity=1024):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        other = 'f2' if self.dtype == 'int8' else 'i1'
+        if os.path.exists(os.path.join(directory, f'vectors.{other}')):
+            raise ValueError(f'Gallery at {self.path} was written with a different GALLERY_DTYPE')
+        existing = os.path.join(directory, 'states.u1')
+        if os.path.exists(existing):
+            capacity = max(capacity, os.path.getsize(existing))
+        self.map_columns(capacity)
+        written = np.flatnonzero(self.states)
+        self.count = int(written[-1]) + 1 if len(written) else 0
+        self.deleted = int(np.count_nonzero(self.states[:self.count] == DELETED))
+        self.build_index()
+
+    def map_columns(self, capacity):
+        self.capacity = capacity
+        for name, dtype in self.columns.items():
+            setattr(self, name, self.map_column(name, dtype, (capacity,)))
+        self.vectors = self.map_column('vectors', np.dtype(self.dtype), (capacity, embedding_dim))
+
+    def map_column(self, name, dtype, shape):
+        dtype = np.dtype(dtype)
+        path = os.path.join(self.directory, f'{name}.{dtype.kind}{dtype.itemsize}')
+        size = int(np.prod(shape)) * dtype.itemsize
+        with open(path, 'ab') as f:
+            if f.tell() < size:
+                f.truncate(size)
+        return np.memmap(path, dtype=dtype, mode='r+', shape=shape)
+
+    def refresh(self):
+        # Catch up with other processes' writes: a compaction that switched generations, files
+        # grown past this process's maps, and rows appended past this process's count. Rows are
+        # appended in order and a row's state is written last, so the new rows end at the first
+        # EMPTY state. Tombstones need no catching up since the states column is shared.
+        generation = self.read_current()
+        if generation is not None and generation != self.generation:
+            self.generation = generation
+            self.open(self.generation_dir(generation))
+            return
+        size = os.path.getsize(os.path.join(self.directory, 'states.u1'))
+        if size > self.capacity:
+            self.map_columns(size)
+        end = self.count
+        while end < self.capacity:
+            empty = np.flatnonzero(self.states[end:end + 4096] == EMPTY)
+            if len(empty):
+                end += int(empty[0])
+                break
+            end = min(end + 4096, self.capacity)
+        for row in range(self.count, end):
+            if self.states[row] == LIVE:
+                self.recent[int(self.ids[row])] = row
+        if end != self.count:
+            self.count = end
+            self.deleted = int(np.count_nonzero(self.states[:self.count] == DELETED))
+
+    def build_index(self):
+        # Sorted ids of the live rows, searched with np.searchsorted; rows appended since then
+        # are looked up in a dict until it grows large enough to merge
+        live = np.flatnonzero(self.states[:self.count] == LIVE)
+        order = np.argsort(self.ids[live], kind='stable')
+        self.sorted_ids = np.asarray(self.ids[live][order])
+        self.sorted_rows = live[order]
+        self.recent = {}
+
+    def __len__(self):
+        with self.lock:
+            self.refresh()
+            return int(np.count_nonzero(self.states[:self.count] == LIVE))
+
+    def live_ids(self):
+        with self.lock:
+            self.refresh()
+            return {str(user_id) for user_id in self.ids[:self.count][self.states[:self.count] == LIVE]}
+
+    def row(self, user_id):
+        row = self.recent.get(user_id)
+        if row is None:
+            i = np.searchsorted(self.sorted_ids, user_id)
+            if i == len(self.sorted_ids) or self.sorted_ids[i] != user_id:
+                return None
+            row = int(self.sorted_rows[i])
+        return row if self.states[row] == LIVE else None
+
+    def get(self, user_id):
+        with self.lock:
+            self.refresh()
+            row = self.row(int(user_id))
+            if row is None:
+                return None
+            return dequantize(self.vectors[row:row + 1], self.scales[row:row + 1])[0]
+
+    def add(self, ids, embeddings):
+        vectors, scales = quantize(embeddings, self.dtype)
+        dequantized = dequantize(vectors, scales)
+        norms = np.einsum('ij,ij->i', dequantized, dequantized)
+        with self.writing(), self.lock:
+            self.refresh()
+            for user_id, vector, scale, norm in zip(ids, vectors, scales, norms):
+                user_id = int(user_id)
+                self.tombstone(user_id)
+                if self.count == self.capacity:
+                    self.flush()
+                    self.map_columns(2 * self.capacity)
+                row = self.count
+                self.ids[row] = user_id
+                self.scales[row] = scale
+                self.norms[row] = norm
+                self.vectors[row] = vector
+                # Written last: a row only exists once its state is set
+                self.states[row] = LIVE
+                self.count += 1
+                self.recent[user_id] = row
+            if len(self.recent) > max(1024, len(self.sorted_ids) // 8):
+                self.build_index()
+        # Re-enrolled users leave a tombstone behind too
+        self.maybe_compact()
+
+    def remove(self, ids):
+        with self.writing(), self.lock:
+            self.refresh()
+            for user_id in ids:
+                self.tombstone(int(user_id))
+        self.maybe_compact()
+
+    def tombstone(self, user_id):
+        row = self.row(user_id)
+        if row is not None:
+            self.states[row] = DELETED
+            self.deleted += 1
+        self.recent.pop(user_id, None)
+
+    def flush(self):
+        for name in list(self.columns) + ['vectors']:
+            getattr(self, name).flush()
+
+    def search(self, queries, k):
+        # Distances are computed on the quantized vectors, block by block, and the winners
+        # re-scored on their dequantized values in the same euclidean/2 metric as the other backends
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, embedding_dim)
+        query_norms = np.einsum('ij,ij->i', queries, queries)[:, None]
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_d2 = np.zeros((len(queries), 0), dtype=np.float32)
+        # Consistent view of the columns in case a compaction swaps them while searching
+        with self.lock:
+            self.refresh()
+            count, ids, states, scales, norms, vectors = (self.count, self.ids, self.states, self.scales,
+                                                          self.norms, self.vectors)
+        for start in range(0, count, search_block_size):
+            end = min(start + search_block_size, count)
+            dots = queries @ vectors[start:end].astype(np.float32).T
+            d2 = norms[start:end] - 2 * dots * scales[start:end] + query_norms
+            d2[:, states[start:end] != LIVE] = np.inf
+            idx = top_k(d2, k)
+            rows = np.concatenate([best_rows, idx + start], axis=1)
+            d2 = np.concatenate([best_d2, np.take_along_axis(d2, idx, axis=1)], axis=1)
+            idx = top_k(d2, k)
+            best_rows = np.take_along_axis(rows, idx, axis=1)
+            best_d2 = np.take_along_axis(d2, idx, axis=1)
+        result_ids, distances = [], []
+        for query, rows, d2 in zip(queries, best_rows, best_d2):
+            rows = rows[np.isfinite(d2)]
+            embeddings = dequantize(vectors[rows], scales[rows])
+            result_ids.append([str(user_id) for user_id in ids[rows]])
+            distances.append(np.linalg.norm(embeddings - query.astype(np.float64), axis=1) / 2)
+        return result_ids, distances
+
+    def maybe_compact(self):
+        if self.compacting or self.count < 1024:
+            return
+        # Counted from the shared states, since other processes tombstone rows too
+        self.deleted = int(np.count_nonzero(self.states[:self.count] == DELETED))
+        if self.deleted < self.compact_ratio * self.count:
+            return
+        self.compacting = True
+        threading.Thread(target=self.compact, name='gallery-compaction', daemon=True).start()
+
+    def compact(self):
+        try:
+            # Writers in every process wait for the whole compaction, so nothing needs catching up
+            # afterwards; searches only wait for the final switch
+            with self.writing():
+                names = list(self.columns) + ['vectors']
+                with self.lock:
+                    generation = self.generation
+                    self.refresh()
+                    if self.generation != generation:
+                        # Another process compacted first
+                        return
+                    self.flush()
+                    count = self.count
+                    old = {name: getattr(self, name) for name in names}
+                live = np.flatnonzero(old['states'][:count] == LIVE)
+                old_dir, generation = self.directory, self.generation + 1
+                new_dir = self.generation_dir(generation)
+                shutil.rmtree(new_dir, ignore_errors=True)
+                compacted = QuantizedGallery.__new__(QuantizedGallery)
+                compacted.dtype = self.dtype
+                compacted.directory = new_dir
+                os.makedirs(new_dir)
+                compacted.map_columns(max(1024, 2 * len(live)))
+                for name, column in old.items():
+                    getattr(compacted, name)[:len(live)] = column[live]
+                compacted.flush()
+                with self.lock:
+                    self.directory = new_dir
+                    self.generation = generation
+                    self.map_columns(compacted.capacity)
+                    self.count = len(live)
+                    self.deleted = 0
+                    self.build_index()
+                    self.write_current()
+                # Other processes keep their maps of the old files valid until they switch
+                shutil.rmtree(old_dir, ignore_errors=True)
+        finally:
+            self.compacting = False
@@ -0,0 +1,216 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import asyncio
+import os
+import time
+
+import numpy as np
+
+from metrics import Counter, Gauge, Histogram, stage_timer
+from preprocess import (DetectorConfig, decode, dedup_threshold, detect, encode, face_models, frame_hash,
+                        hash_distance)
+
+# dlib releases the GIL while detecting and encoding, so threads scale across cores;
+# set INFERENCE_EXECUTOR=process to isolate inference in worker processes instead
+inference_executor_kind = os.environ.get('INFERENCE_EXECUTOR', 'thread')
+inference_workers = int(os.environ.get('INFERENCE_WORKERS', os.cpu_count() or 1))
+# Number of requests allowed to wait for a free worker before new ones are rejected
+inference_queue_size = int(os.environ.get('INFERENCE_QUEUE_SIZE', 4 * inference_workers))
+# Seconds a rejected client is asked to wait before retrying
+inference_retry_after = int(os.environ.get('INFERENCE_RETRY_AFTER', 1))
+
+# Frames uploaded to /sessions within max_wait of each other are encoded as one batch when the sessions
+# detector is the CNN one, the only one dlib can run batched; otherwise each frame gets its own worker
+batch_max_size = int(os.environ.get('BATCH_MAX_SIZE', 16))
+batch_max_wait_ms = float(os.environ.get('BATCH_MAX_WAIT_MS', 5))
+
+batch_size_histogram = Histogram('inference_batch_size', 'Frames per inference batch',
+                                 [1, 2, 4, 8, 16, 32, 64, 128])
+batch_wait_histogram = Histogram('inference_batch_wait_seconds', 'Time frames wait in the batching queue',
+                                 [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25])
+
+frames_encoded = Counter('session_frames_encoded_total', 'Session frames run through face encoding')
+frames_skipped = Counter('session_frames_skipped_total', 'Near-duplicate session frames that reused the previous result')
+
+class InferenceQueueFull(Exception):
+    pass
+
+class InferenceExecutor:
+    def __init__(self, kind, max_workers, max_queue):
+        if kind == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='inference')
+        self.max_pending = max_workers + max_queue
+        # Frames running or waiting, so a batch counts for each of its frames. Only touched from the
+        # event loop thread, so no lock is needed
+        self.pending = 0
+        self.capacity = None
+
+    async def run(self, fn, *args, block=False, cost=1):
+        # Reject instead of queueing so latency stays flat when we're saturated; long-running
+        # callers that already hold a slot can block for the next one instead. cost is the number
+        # of frames fn works through; a batch larger than the whole bound still runs on its own
+        cost = max(1, min(cost, self.max_pending))
+        if self.pending + cost > self.max_pending:
+            if not block:
+                raise InferenceQueueFull()
+            if self.capacity is None:
+                self.capacity = asyncio.Condition()
+            async with self.capacity:
+                await self.capacity.wait_for(lambda: self.pending + cost <= self.max_pending)
+        self.pending += cost
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.pending -= cost
+            if self.capacity is not None:
+                # Every waiter re-checks for room, so a cancelled waiter or one needing more slots
+                # than were freed can't keep the others asleep
+                async with self.capacity:
+                    self.capacity.notify_all()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class MicroBatcher:
+    # With batched False every item is sent to the pool on its own as soon as it is submitted, so
+    # items whose work can't be batched keep running in parallel across the workers
+    def __init__(self, executor, fn, max_batch_size, max_wait_ms, batched=True):
+        self.executor = executor
+        self.fn = fn
+        self.max_batch_size = max_batch_size if batched else 1
+        self.max_wait = max_wait_ms / 1000
+        self.pending = []
+        self.flush_handle = None
+        # Hold references so in-flight batches aren't garbage collected
+        self.tasks = set()
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future, time.perf_counter()))
+        if len(self.pending) >= self.max_batch_size or self.max_wait <= 0:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.max_wait, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        now = time.perf_counter()
+        batch_size_histogram.observe(len(batch))
+        for _, _, enqueued in batch:
+            batch_wait_histogram.observe(now - enqueued)
+        task = asyncio.ensure_future(self.run(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, batch):
+        # Fan the batch results (or its error) back out to the waiting requests
+        try:
+            results = await self.executor.run(self.fn, [item for item, _, _ in batch], cost=len(batch))
+        except Exception as exc:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for (_, future, _), result in zip(batch, results):
+            if future.done():
+                continue
+            # fn may return an item's exception in place of its result
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+def register_executor_metrics(executor):
+    Gauge('inference_requests_pending', 'Inference calls running or waiting for a worker', lambda: executor.pending)
+
+async def run_many(fn, items):
+    # Await fn(item, block) for every item concurrently, where fn runs work on the pool; only the
+    # first can be rejected with a 503, the rest wait for a free worker
+    tasks = [asyncio.ensure_future(fn(item, i > 0)) for i, item in enumerate(items)]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def locate_and_encode(file, config=DetectorConfig()):
+    with stage_timer('decode'):
+        image = decode(file, config)
+    if image is None:
+        raise ValueError('Could not decode image')
+    with stage_timer('detect'):
+        locations = detect(image, config)
+    with stage_timer('encode'):
+        return locations, encode(image, locations, config)
+
+def frame_distance(frame, baseline_embedding, config=DetectorConfig()):
+    # Returns (distance to the first face found, number of faces); frames without a face
+    # score the maximum distance, as in post_session_image
+    with stage_timer('detect'):
+        locations = detect(frame, config)
+    with stage_timer('encode'):
+        face_embeddings = encode(frame, locations, config)
+    if len(face_embeddings) == 0:
+        return 1.0, 0
+    distance = np.linalg.norm(np.array([baseline_embedding]) - face_embeddings[0], axis=1).item()/2
+    return distance, len(face_embeddings)
+
+def encode_batch(items, config=DetectorConfig()):
+    # items are (file, region of interest, hash of the session's last encoded frame), either of the
+    # last two possibly None; returns (locations, encodings, frame hash, skipped) for each, or the
+    # exception an item raised so that one bad upload only fails its own request
+    # Stages are timed per batch here, hence their own labels
+    results = [None] * len(items)
+    images = [None] * len(items)
+    with stage_timer('batch_decode'):
+        for i, (file, _, _) in enumerate(items):
+            try:
+                images[i] = decode(file, config)
+                if images[i] is None:
+                    raise ValueError('Could not decode image')
+            except Exception as exc:
+                results[i] = exc
+    decoded = [i for i, result in enumerate(results) if result is None]
+    with stage_timer('batch_hash'):
+        hashes = [frame_hash(image) if image is not None and dedup_threshold >= 0 else None for image in images]
+    skipped = [last_hash is not None and frame_hash_ is not None
+               and hash_distance(frame_hash_, last_hash) <= dedup_threshold
+               for (_, _, last_hash), frame_hash_ in zip(items, hashes)]
+    for i in decoded:
+        if skipped[i]:
+            results[i] = (None, None, hashes[i], True)
+    todo = [i for i in decoded if not skipped[i]]
+    frames_skipped.inc(len(decoded) - len(todo))
+    frames_encoded.inc(len(todo))
+    with stage_timer('batch_detect'):
+        if (config.model == 'cnn' and not config.detector_width and all(items[i][1] is None for i in todo)
+                and len({images[i].shape for i in todo}) == 1):
+            # dlib's batched CNN detector needs every frame to be the same size
+            locations = face_models().batch_face_locations([images[i] for i in todo],
+                                                           number_of_times_to_upsample=config.upsample,
+                                                           batch_size=len(todo))
+        else:
+            locations = []
+            for i in todo:
+                try:
+                    locations.append(detect(images[i], config, items[i][1]))
+                except Exception as exc:
+                    locations.append(exc)
+    with stage_timer('batch_encode'):
+        for i, image_locations in zip(todo, locations):
+            if isinstance(image_locations, Exception):
+                results[i] = image_locations
+                continue
+            try:
+                results[i] = (image_locations, encode(images[i], image_locations, config), hashes[i], False)
+            except Exception as exc:
+                results[i] = exc
+    return results
@@ -1,21 +1,39 @@
-from fastapi import FastAPI, File
-from fastapi.responses import PlainTextResponse
-from pydantic import BaseModel, ConfigDict
+from fastapi import Depends, FastAPI, File, Header, Request, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
 from lru import LRU
-import cv2
-import face_recognition
 import numpy as np
 import os
-import chromadb
-import imageio.v3 as iio
-
-class Session(BaseModel):
-    user_id: int
-    distances: dict[int, float]
-    baseline_embedding: list[float]
-    model_config = ConfigDict(
-        arbitrary_types_allowed=True,
-    )
+import asyncio
+import functools
+import hmac
+import io
+import json
+import shutil
+import tempfile
+import uuid
+import zipfile
+from collections import deque
+from contextlib import asynccontextmanager
+from inference import (InferenceExecutor, InferenceQueueFull, MicroBatcher, batch_max_size,
+                       batch_max_wait_ms, encode_batch, locate_and_encode, run_many,
+                       inference_executor_kind, inference_queue_size, inference_retry_after,
+                       inference_workers, register_executor_metrics)
+from enrollment import (EnrollmentJournal, EnrollmentProgress, bulk_batch_size, face_count_message,
+                        iter_archive, iter_manifest, job_id_pattern)
+from digest_cache import DigestCache, upload_digest
+from embedding_store import EmbeddingStore, register_metrics
+from metrics import (InstrumentationMiddleware, chroma_seconds, mark_body_parsed, metrics_enabled, profile_dir,
+                     render_metrics, stage_timer)
+from session_archive import SessionArchive, session_archive_path
+from session_store import make_session_store, register_store_metrics, session_backend
+from sessions import session_cache_size
+from preprocess import (FrameHint, RawUploadError, dedup_max_skipped, detector_configs, is_raw_embeddings,
+                        raw_embeddings)
+from search import make_search_backend, search_backend
+from startup import Lazy, preload, preload_models, resolve, warm_up
+from video import sample_frames, score_frames, video_frame_stride
+from video_jobs import VideoJob, VideoJobRunner, video_jobs_dir
 
 class SessionResult(BaseModel):
     session_id: str | None
@@ -24,148 +42,799 @@ class SessionResult(BaseModel):
     avg_distance: float
     std_distance: float
 
+class SessionResultsQuery(BaseModel):
+    # Every live session when omitted
+    session_ids: list[str] | None = None
+    # Only sessions whose pct_present is below this fraction
+    max_pct_present: float | None = None
+    # Only sessions that received a frame at or after this unix time
+    updated_since: float | None = None
+    # 'objects' (a list of SessionResult) or 'columns' (one list per SessionResult field, so
+    # field names aren't repeated for every session)
+    format: str = 'objects'
+
+class ArchiveRescoreQuery(SessionResultsQuery):
+    # Distance threshold under which a frame counts as present, in place of ID_THRESHOLD
+    threshold: float
+
+class FrameResult(BaseModel):
+    frame_index: int | None
+    timestamp: float | None
+    distance: float
+    faces_found: int
+
+class VideoDistanceResult(SessionResult):
+    frames_scored: int
+    early_exit: bool
+    timeline: list[FrameResult]
+
+class VideoJobResult(BaseModel):
+    job_id: str
+    user_id: int
+    # queued, running, done, failed or cancelled
+    status: str
+    frames_scored: int
+    early_exit: bool
+    # Stats over the frames scored so far, until result holds the final SessionResult
+    pct_present: float | None
+    avg_distance: float | None
+    std_distance: float | None
+    result: SessionResult | None
+    error: str | None
+
+class FaceBox(BaseModel):
+    top: int
+    right: int
+    bottom: int
+    left: int
+
+class FaceSearchResult(BaseModel):
+    box: FaceBox
+    matches: dict[str, float]
+
+class ImageSearchResult(BaseModel):
+    image: str
+    faces: list[FaceSearchResult]
+    # Set when the image (e.g. a non-image zip entry) could not be decoded
+    error: str | None = None
+
 id_threshold = 0.3
 
-# If chroma db doesn't exist, create it
-if not os.path.exists('chroma'):
-    os.makedirs('chroma')
+# Frames allowed to wait per WebSocket session stream before the oldest is dropped
+stream_queue_size = int(os.environ.get('STREAM_QUEUE_SIZE', 2))
+# Scored frames between SessionResult updates pushed to WebSocket clients
+stream_result_interval = int(os.environ.get('STREAM_RESULT_INTERVAL', 10))
+
+# Images (zip entries included) and total uncompressed bytes accepted by one /users/search/batch call
+search_batch_max_images = int(os.environ.get('SEARCH_BATCH_MAX_IMAGES', 256))
+search_batch_max_bytes = int(os.environ.get('SEARCH_BATCH_MAX_BYTES', 256 * 1024 * 1024))
+
+# Shared secret that lets a client upload precomputed embeddings (X-Embedding-Token header) instead
+# of images; embedding uploads are refused while it is unset
+raw_embedding_token = os.environ.get('RAW_EMBEDDING_TOKEN')
+untrusted_embeddings_message = 'Embedding uploads require a valid X-Embedding-Token'
 
-# Load chroma database of known face embeddings
 chroma_dir = 'chroma'
-chroma_client = chromadb.PersistentClient(path=chroma_dir)
-chroma_collection = chroma_client.get_or_create_collection(name="user_embeddings")
 
-app = FastAPI()
+def open_chroma_collection():
+    import chromadb
+    # If chroma db doesn't exist, create it
+    if not os.path.exists(chroma_dir):
+        os.makedirs(chroma_dir)
+    # Load chroma database of known face embeddings
+    chroma_client = chromadb.PersistentClient(path=chroma_dir)
+    return chroma_client.get_or_create_collection(name="user_embeddings")
+
+# Opened on first use, or by the lifespan hook before the app reports ready, so importing this
+# module stays fast and holds no database connections (it may be imported before forking workers)
+chroma_collection = Lazy(open_chroma_collection)
+
+def load_user_embedding(user_id):
+    # Fetch user's face encoding from database
+    with stage_timer('get', chroma_seconds):
+        db_result = chroma_collection.get(ids=[str(user_id)],include=['embeddings'],)
+    if len(db_result["ids"]) == 0:
+        return None
+    return db_result["embeddings"][0]
+
+if preload_models:
+    preload()
+
+@asynccontextmanager
+async def lifespan(app):
+    # Load everything that was deferred and run a warm-up inference before reporting ready, so the
+    # first real request doesn't pay for it
+    global chroma_collection
+    chroma_collection = await asyncio.to_thread(resolve, chroma_collection)
+    app.search = await asyncio.to_thread(resolve, app.search)
+    app.sessions = await asyncio.to_thread(resolve, app.sessions)
+    await warm_up(app.inference, detector_configs.values(), inference_workers)
+    maintenance = asyncio.create_task(maintain_sessions())
+    app.ready = True
+    try:
+        yield
+    finally:
+        app.ready = False
+        maintenance.cancel()
+        app.video_jobs.shutdown()
+        app.inference.shutdown()
+        app.sessions.close()
+        if app.session_archive is not None:
+            app.session_archive.flush()
+
+# Per-stage timers and request profiling are exported on /metrics; see metrics.py for the switches
+app = FastAPI(lifespan=lifespan, dependencies=[Depends(mark_body_parsed)] if metrics_enabled else [])
+app.ready = False
+if metrics_enabled or profile_dir:
+    app.add_middleware(InstrumentationMiddleware)
+
+# Baseline embeddings are read through an in-memory float32 matrix instead of hitting chroma every request
+app.embeddings = EmbeddingStore(load_user_embedding)
+register_metrics(app.embeddings)
 
-# Using LRU dictionary as cache - consider using redis or memcached for production
-app.cache = LRU(1024)
+# Identification runs against a pluggable index kept in sync with the database
+app.search = Lazy(lambda: make_search_backend(search_backend, chroma_collection))
+
+# Sessions live in a pluggable store: a per-process LRU by default, or SQLite / Redis so that
+# several workers or nodes can serve frames for the same session
+# Deleted and evicted sessions are kept in a columnar archive when SESSION_ARCHIVE_PATH is set
+app.session_archive = SessionArchive() if session_archive_path else None
+app.sessions = Lazy(lambda: make_session_store(session_backend, id_threshold, app.session_archive))
+register_store_metrics(app.sessions, session_backend)
+
+# Face detection and encoding run off the event loop on a bounded worker pool
+app.inference = InferenceExecutor(inference_executor_kind, inference_workers, inference_queue_size)
+register_executor_metrics(app.inference)
+# Session frames are micro-batched before they reach the pool when the detector can batch them
+app.session_batcher = MicroBatcher(app.inference, functools.partial(encode_batch, config=detector_configs['sessions']),
+                                   batch_max_size, batch_max_wait_ms,
+                                   batched=detector_configs['sessions'].model == 'cnn')
+# Faces found in recent uploads, so resubmitted images skip decoding and encoding
+app.digest_cache = DigestCache()
+
+# Long videos are scored in the background instead of holding the request open
+app.video_jobs = VideoJobRunner(app.inference, detector_configs['video_distance'], inference_workers)
+
+# Last encoded frame of each session, for ROI tracking and near-duplicate detection
+app.frame_hints = LRU(session_cache_size)
+
+async def encode_upload(file, endpoint, block=False):
+    # Returns (face locations, face encodings) for an uploaded image, from the cache when the
+    # same bytes have been seen before
+    config = detector_configs[endpoint]
+    cache = app.digest_cache
+    with stage_timer('digest_lookup'):
+        key = upload_digest(file, config)
+        cached = cache.get_memory(key)
+        if cached is None and cache.disk_bytes > 0:
+            # The disk tier loads and writes files, so it is used from a worker thread
+            cached = await asyncio.to_thread(cache.get_disk, key)
+            if cached is not None:
+                cache.remember(key, *cached)
+    if cached is not None:
+        return cached
+    locations, encodings = await app.inference.run(locate_and_encode, file, config, block=block)
+    cache.remember(key, locations, encodings)
+    if cache.disk_bytes > 0:
+        await asyncio.to_thread(cache.put_disk, key, locations, encodings)
+    return locations, encodings
+
+@app.exception_handler(InferenceQueueFull)
+async def inference_queue_full_handler(request: Request, exc: InferenceQueueFull):
+    return JSONResponse('Inference queue full, retry later', status_code=503,
+                        headers={'Retry-After': str(inference_retry_after)})
+
+@app.exception_handler(RawUploadError)
+async def raw_upload_error_handler(request: Request, exc: RawUploadError):
+    return JSONResponse(str(exc), status_code=400)
+
+async def call_store(method, *args):
+    # The SQLite and Redis session stores block on disk, locks and the network, so they are called
+    # from a worker thread; the in-process store is cheap enough to call inline
+    if session_backend == 'memory':
+        return method(*args)
+    return await asyncio.to_thread(method, *args)
+
+async def maintain_sessions():
+    # Buffered frame writes reach the shared store within a second even when traffic stops, and
+    # sessions past their TTL are dropped (and archived) even if never read again. Deleted and
+    # evicted sessions are only buffered by the archive; full batches are written here, off the loop
+    while True:
+        await asyncio.sleep(1)
+        await call_store(app.sessions.flush)
+        await call_store(app.sessions.purge_expired)
+        if app.session_archive is not None:
+            await asyncio.to_thread(app.session_archive.write_due)
+
+def is_trusted(token):
+    return bool(raw_embedding_token) and token is not None and hmac.compare_digest(token, raw_embedding_token)
+
+async def score_session_frame(session_id, user_id, timestamp, file, token=None):
+    # Shared by the HTTP and WebSocket ingestion paths; returns (status message, distance or None)
+    if is_raw_embeddings(file) and not is_trusted(token):
+        return untrusted_embeddings_message, None
+    with stage_timer('session_lookup'):
+        session = await call_store(app.sessions.get, session_id, False)
+    if session is None:
+        # Fetch baseline encoding
+        with stage_timer('embedding_lookup'):
+            baseline_embedding = app.embeddings.get(user_id)
+        if baseline_embedding is None:
+            return 'User not found', None
+        # Add new session to the store
+        session = await call_store(app.sessions.create, session_id, user_id, baseline_embedding)
+        # The store may have expired or evicted an earlier session with this id without going through
+        # delete_session, so its hint must not carry over
+        app.frame_hints.pop(session_id, None)
+    # Ensure user ID matches the session's user ID
+    if user_id != session.user_id:
+        return 'User ID does not match session ID', None
+    if is_raw_embeddings(file):
+        # The client already encoded the frame
+        session_face_embeddings = raw_embeddings(file, min_count=0)
+    else:
+        session_face_embeddings = await encode_session_frame(session_id, file)
+    # Save the distance of the nearest face in the uploaded image
+    distance = session.nearest_distance(session_face_embeddings)
+    with stage_timer('session_append'):
+        appended = await call_store(app.sessions.append, session_id, timestamp, distance)
+    if not appended:
+        return 'Session not found', None
+    return 'Image received', distance
+
+async def encode_session_frame(session_id, file):
+    hint = app.frame_hints.get(session_id)
+    roi = hint.box if hint is not None else None
+    last_hash = hint.frame_hash if hint is not None and hint.skipped < dedup_max_skipped else None
+    face_locations, session_face_embeddings, frame_hash, skipped = await app.session_batcher.submit((file, roi, last_hash))
+    if skipped:
+        # Near-duplicate of the last encoded frame, so reuse its faces
+        hint.skipped += 1
+        return hint.embeddings
+    app.frame_hints[session_id] = FrameHint(face_locations, session_face_embeddings, frame_hash)
+    return session_face_embeddings
 
 @app.post("/sessions")
-async def post_session_image(session_id: str, user_id: int, timestamp: int, file: bytes = File(...)):
+async def post_session_image(session_id: str, user_id: int, timestamp: int, file: bytes = File(...),
+                             x_embedding_token: str | None = Header(None)):
+    # file is a JPEG, a raw frame or, for trusted clients, raw embeddings (see preprocess.py)
     if session_id is None:
         return 'Session ID is required'
-    if session_id not in app.cache:
-        # Fetch baseline encoding from database
-        baseline_embedding = chroma_collection.get(ids=[str(user_id)],include=['embeddings'],)["embeddings"][0]
-        # Add new session to cache
-        app.cache[session_id] = Session(user_id=user_id, distances={}, baseline_embedding=baseline_embedding)
-    # Ensure user ID matches the session's user ID
-    if user_id != app.cache[session_id].user_id:
-        return 'User ID does not match session ID'
-    # Convert file bytes to RGB numpy array
-    img_array = cv2.imdecode(np.frombuffer(file, dtype=np.uint8), cv2.IMREAD_COLOR)
-    session_face_embeddings = face_recognition.face_encodings(img_array)
-    # Save the distance of the nearest face in the uploaded image
-    min_distance = 1
-    for face_embedding in session_face_embeddings:
-        distance = np.linalg.norm(np.array([app.cache[session_id].baseline_embedding]) - face_embedding, axis=1).item()/2
-        min_distance = min(min_distance, distance)
-    app.cache[session_id].distances[timestamp] = min_distance
-    return 'Image received'
+    message, _ = await score_session_frame(session_id, user_id, timestamp, file, x_embedding_token)
+    return message
+
+@app.websocket("/sessions/{session_id}/stream")
+async def stream_session_images(websocket: WebSocket, session_id: str, user_id: int):
+    # Each binary message is an 8-byte little-endian signed timestamp followed by the JPEG bytes.
+    # Every scored frame is acknowledged with its distance, and a SessionResult is pushed every
+    # stream_result_interval frames. When inference falls behind, the oldest waiting frame is
+    # dropped so the newest is always the next one scored.
+    await websocket.accept()
+    token = websocket.headers.get('x-embedding-token')
+    queue = asyncio.Queue(maxsize=stream_queue_size)
+    dropped = 0
+
+    async def score_frames():
+        scored = 0
+        while True:
+            timestamp, file = await queue.get()
+            try:
+                message, distance = await score_session_frame(session_id, user_id, timestamp, file, token)
+            except InferenceQueueFull:
+                message, distance = 'Inference queue full, frame dropped', None
+            except ValueError as exc:
+                # A frame that can't be decoded (or a malformed raw upload) only fails itself
+                message, distance = str(exc), None
+            await websocket.send_json({'timestamp': timestamp, 'status': message, 'distance': distance,
+                                       'dropped': dropped})
+            if message in ('User not found', 'User ID does not match session ID', 'Session not found',
+                           untrusted_embeddings_message):
+                await websocket.close(code=1008)
+                return
+            if distance is not None:
+                scored += 1
+                if scored % stream_result_interval == 0:
+                    result = await whole_session_result(session_id)
+                    if isinstance(result, SessionResult):
+                        await websocket.send_json({'result': result.model_dump()})
+
+    scorer = asyncio.create_task(score_frames())
+    try:
+        while not scorer.done():
+            receive = asyncio.ensure_future(websocket.receive())
+            await asyncio.wait([receive, scorer], return_when=asyncio.FIRST_COMPLETED)
+            if not receive.done():
+                receive.cancel()
+                break
+            message = receive.result()
+            if message['type'] == 'websocket.disconnect':
+                break
+            message = message.get('bytes')
+            if message is None:
+                # Frames are binary messages; text is a protocol error on the client's side
+                await websocket.close(code=1003)
+                break
+            if len(message) < 8:
+                continue
+            if queue.full():
+                queue.get_nowait()
+                dropped += 1
+            queue.put_nowait((int.from_bytes(message[:8], 'little', signed=True), message[8:]))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        scorer.cancel()
+    if scorer.done() and not scorer.cancelled() and scorer.exception() is not None:
+        raise scorer.exception()
+
+def session_result(session_id, session, stats):
+    pct_present, avg_distance, std_distance = stats
+    return SessionResult(
+      session_id=session_id,
+      user_id=session.user_id,
+      pct_present=pct_present,
+      avg_distance=avg_distance,
+      std_distance=std_distance
+    )
+
+async def whole_session_result(session_id):
+    # From the store's running or SQL aggregates, so the shared stores don't load every frame
+    columns = await call_store(app.sessions.columns, [session_id])
+    if not columns.session_ids:
+        return 'Session not found'
+    if columns.frame_counts[0] == 0:
+        return 'No frames received for session'
+    pct_present, avg_distance, std_distance = (values[0].item() for values in columns.stats())
+    return SessionResult(session_id=session_id, user_id=int(columns.user_ids[0]), pct_present=pct_present,
+                         avg_distance=avg_distance, std_distance=std_distance)
+
+@app.post("/sessions/results")
+async def get_many_session_results(query: SessionResultsQuery):
+    # Results for many sessions in one call, aggregated and filtered in vectorized passes
+    if query.format not in ('objects', 'columns'):
+        return "Format must be 'objects' or 'columns'"
+    return session_results(await call_store(app.sessions.columns, query.session_ids), query)
+
+@app.post("/sessions/archive/rescore")
+async def rescore_archived_sessions(query: ArchiveRescoreQuery):
+    # Results of archived sessions recomputed under another threshold from their stored distances
+    if query.format not in ('objects', 'columns'):
+        return "Format must be 'objects' or 'columns'"
+    if app.session_archive is None:
+        return 'Session archive is disabled'
+    columns = await asyncio.to_thread(app.session_archive.rescore, query.threshold, query.session_ids)
+    return session_results(columns, query)
+
+def session_results(columns, query):
+    # SessionColumns filtered by the query and laid out in its format
+    pct_present, avg_distance, std_distance = columns.stats()
+    # Sessions without frames have no result, as in GET /sessions/{session_id}
+    keep = columns.frame_counts > 0
+    if query.max_pct_present is not None:
+        keep &= pct_present < query.max_pct_present
+    if query.updated_since is not None:
+        keep &= columns.updated_at >= query.updated_since
+    fields = {
+        'session_id': [session_id for session_id, kept in zip(columns.session_ids, keep.tolist()) if kept],
+        'user_id': columns.user_ids[keep].tolist(),
+        'pct_present': pct_present[keep].tolist(),
+        'avg_distance': avg_distance[keep].tolist(),
+        'std_distance': std_distance[keep].tolist(),
+    }
+    if query.format == 'columns':
+        return fields
+    return [dict(zip(fields, values)) for values in zip(*fields.values())]
 
 @app.get("/sessions/{session_id}")
-async def get_session_results(session_id: str):
-    if session_id in app.cache:
-        # Return the minimum distance from the session
-        return SessionResult(
-          session_id=session_id,
-          user_id=app.cache[session_id].user_id,
-          pct_present=len(dict((k, v) for k, v in app.cache[session_id].distances.items() if v <= id_threshold))/len(app.cache[session_id].distances),
-          avg_distance=np.mean(list(app.cache[session_id].distances.values())),
-          std_distance=np.std(list(app.cache[session_id].distances.values()))
-        )
+async def get_session_results(session_id: str, start: int | None = None, end: int | None = None,
+                              last: int | None = None):
+    if start is None and end is None and last is None:
+        return await whole_session_result(session_id)
+    session = await call_store(app.sessions.get, session_id)
+    if session is not None:
+        if len(session) == 0:
+            return 'No frames received for session'
+        if last is not None:
+            # Frames within `last` timestamp units of the most recent one
+            start = session.timestamps[-1] - last
+        stats = session.window_stats(start, end)
+        if stats is None:
+            return 'No frames in the requested window'
+        return session_result(session_id, session, stats)
     else:
         return 'Session not found'
 
 @app.delete("/sessions/{session_id}")
 async def delete_session(session_id: str):
-    if session_id in app.cache:
-        del app.cache[session_id]
+    if session_id in app.frame_hints:
+        del app.frame_hints[session_id]
+    if await call_store(app.sessions.delete, session_id):
         return 'Session deleted'
     else:
         return 'Session not found'
 
 @app.get("/users/{user_id}")
 async def get_user_embedding(user_id: int):
-    # Fetch user's face encoding from database
-    db_result = chroma_collection.get(ids=[str(user_id)],include=['embeddings'],)
-    if len(db_result["ids"]) == 0:
+    # Fetch user's face encoding
+    baseline_embedding = app.embeddings.get(user_id)
+    if baseline_embedding is None:
         return 'User not found'
-    return db_result["embeddings"]
+    return [baseline_embedding.tolist()]
+
+async def search_faces(embeddings, n_results):
+    # A search scans the whole gallery (and may first replay other workers' writes against the
+    # database), so it runs in a worker thread
+    return await asyncio.to_thread(app.search.search, embeddings, n_results)
 
 @app.post("/users/search")
 async def search_users_by_image_similarity(file: bytes = File(...), n_results: int = 1):
-    # Convert file bytes to RGB numpy array
-    img_array = cv2.imdecode(np.frombuffer(file, dtype=np.uint8), cv2.IMREAD_COLOR)
-    face_embedding = face_recognition.face_encodings(img_array)[0]
-    db_result = chroma_collection.query(face_embedding.tolist(), n_results=n_results, 
-                include=['distances'],)
-    if len(db_result["ids"]) == 0:
+    face_embedding = (await encode_upload(file, 'search'))[1][0]
+    with stage_timer('search'):
+        ids, distances = await search_faces(np.array([face_embedding]), n_results)
+    if len(ids[0]) == 0:
         return 'User not found'
-    return dict(zip(db_result["ids"][0], db_result["distances"][0]))
+    return dict(zip(ids[0], np.asarray(distances[0]).tolist()))
+
+def read_search_images(uploads):
+    # Expand any zip archives so each entry is searched as its own image. Runs in a worker thread;
+    # raises ValueError when the batch is over the limits, which are checked against each entry's
+    # declared size before it is decompressed (zipfile never reads past that size)
+    images = []
+    total = 0
+
+    def take(size):
+        nonlocal total
+        total += size
+        if len(images) >= search_batch_max_images:
+            raise ValueError(f'At most {search_batch_max_images} images can be searched at once')
+        if total > search_batch_max_bytes:
+            raise ValueError(f'Images may total at most {search_batch_max_bytes} bytes uncompressed')
+
+    for name, data in uploads:
+        if zipfile.is_zipfile(io.BytesIO(data)):
+            try:
+                with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                    for info in archive.infolist():
+                        if not info.is_dir():
+                            take(info.file_size)
+                            images.append((info.filename, archive.read(info)))
+            except zipfile.BadZipFile:
+                raise ValueError(f'Could not read zip archive {name}')
+        else:
+            take(len(data))
+            images.append((name, data))
+    return images
+
+async def search_image_faces(data, block):
+    # (locations, encodings) of an image, or None if it isn't one that can be decoded
+    try:
+        return await encode_upload(data, 'search', block=block)
+    except ValueError:
+        return None
+
+@app.post("/users/search/batch")
+async def search_users_by_image_batch(files: list[UploadFile] = File(...), n_results: int = 1):
+    uploads = [(upload.filename, await upload.read()) for upload in files]
+    try:
+        images = await asyncio.to_thread(read_search_images, uploads)
+    except ValueError as exc:
+        return JSONResponse(str(exc), status_code=400)
+    if len(images) == 0:
+        return 'No images uploaded'
+    # Detect and encode every face in every image on the pool
+    detections = await run_many(search_image_faces, [data for _, data in images])
+    embeddings = [embedding for detection in detections if detection is not None for embedding in detection[1]]
+    # Then identify all of the faces with one vectorized search
+    with stage_timer('search'):
+        ids, distances = await search_faces(np.array(embeddings), n_results) if embeddings else ([], [])
+    results = []
+    face_index = 0
+    for (name, _), detection in zip(images, detections):
+        if detection is None:
+            results.append(ImageSearchResult(image=name, faces=[], error='Could not decode image'))
+            continue
+        faces = []
+        for top, right, bottom, left in detection[0]:
+            faces.append(FaceSearchResult(
+                box=FaceBox(top=top, right=right, bottom=bottom, left=left),
+                matches=dict(zip(ids[face_index], np.asarray(distances[face_index]).tolist()))
+            ))
+            face_index += 1
+        results.append(ImageSearchResult(image=name, faces=faces))
+    return results
 
 @app.post("/users/{user_id}/image-distance")
-async def calculate_user_image_distance(user_id: int, file: bytes = File(...)):
-    # Fetch user's face encoding from database
-    db_result = chroma_collection.get(ids=[str(user_id)],include=['embeddings'],)
-    if len(db_result["ids"]) == 0:
+async def calculate_user_image_distance(user_id: int, file: bytes = File(...),
+                                        x_embedding_token: str | None = Header(None)):
+    # Fetch user's face encoding
+    baseline_embedding = app.embeddings.get(user_id)
+    if baseline_embedding is None:
         return 'User not found'
-    # Convert file bytes to RGB numpy array
-    img_array = cv2.imdecode(np.frombuffer(file, dtype=np.uint8), cv2.IMREAD_COLOR)
-    face_embedding = face_recognition.face_encodings(img_array)[0]
-    return np.linalg.norm(np.array([db_result["embeddings"][0]]) - face_embedding, axis=1).item()/2
+    if is_raw_embeddings(file):
+        if not is_trusted(x_embedding_token):
+            return untrusted_embeddings_message
+        face_embedding = raw_embeddings(file)[0]
+    else:
+        face_embedding = (await encode_upload(file, 'image_distance'))[1][0]
+    return np.linalg.norm(np.array([baseline_embedding]) - face_embedding, axis=1).item()/2
+
+def scoring_error(max_ci_width, confidence):
+    # Message for early-exit settings the confidence interval can't be computed with, or None
+    if not 0 < confidence < 1:
+        return 'Confidence must be between 0 and 1'
+    if max_ci_width is not None and max_ci_width <= 0:
+        return 'max_ci_width must be positive'
+    return None
 
 @app.post("/users/{user_id}/video-distance")
-async def calculate_user_video_distance(user_id: int, file: bytes = File(...)):
-    # Fetch user's face encoding from database
-    db_result = chroma_collection.get(ids=[str(user_id)],include=['embeddings'],)
-    if len(db_result["ids"]) == 0:
+async def calculate_user_video_distance(user_id: int, file: bytes = File(...), stride: int = video_frame_stride,
+                                        fps: float | None = None, keyframes: bool = False,
+                                        max_ci_width: float | None = None, confidence: float = 0.95,
+                                        timeline: bool = False):
+    # Fetch user's face encoding
+    baseline_embedding = app.embeddings.get(user_id)
+    if baseline_embedding is None:
         return 'User not found'
-    # Convert video bytes to np stack
-    frames = np.stack(iio.imread(file, index=None, extension=".mp4"))
-    distances = []
-    frame_count = 0
-    for frame in frames:
-        frame_count += 1
-        if frame_count % 10 == 0:
-            face_embedding = face_recognition.face_encodings(frame)[0]
-            distances.append(np.linalg.norm(np.array([db_result["embeddings"][0]]) - face_embedding, axis=1).item()/2)
-    return SessionResult(
+    if stride < 1:
+        return 'Stride must be at least 1'
+    error = scoring_error(max_ci_width, confidence)
+    if error is not None:
+        return JSONResponse(error, status_code=400)
+    # Decode only the sampled frames and encode them across the inference pool
+    frames = sample_frames(file, stride=stride, fps=fps, keyframes=keyframes)
+    frame_results, early_exit = await score_frames(app.inference, frames, baseline_embedding, id_threshold,
+                                                   inference_workers, detector_configs['video_distance'],
+                                                   max_ci_width=max_ci_width,
+                                                   confidence=confidence)
+    if len(frame_results) == 0:
+        return 'No frames sampled from the video'
+    distances = [distance for _, _, distance, _ in frame_results]
+    result = SessionResult(
             session_id=None,
             user_id=user_id,
             pct_present=len([d for d in distances if d <= id_threshold])/len(distances),
             avg_distance=np.mean(distances),
             std_distance=np.std(distances)
         )
+    if not timeline:
+        return result
+    return VideoDistanceResult(
+            **result.model_dump(),
+            frames_scored=len(frame_results),
+            early_exit=early_exit,
+            timeline=[FrameResult(frame_index=frame_index, timestamp=timestamp, distance=distance,
+                                  faces_found=faces_found)
+                      for frame_index, timestamp, distance, faces_found in frame_results]
+        )
+
+@app.post("/users/{user_id}/video-jobs")
+async def create_video_job(user_id: int, request: Request, stride: int = video_frame_stride,
+                           fps: float | None = None, keyframes: bool = False,
+                           max_ci_width: float | None = None, confidence: float = 0.95):
+    # Same scoring as video-distance, but the upload is spooled to disk and scored in the
+    # background; poll GET /video-jobs/{job_id} for progress and the result
+    baseline_embedding = app.embeddings.get(user_id)
+    if baseline_embedding is None:
+        return 'User not found'
+    if stride < 1:
+        return 'Stride must be at least 1'
+    error = scoring_error(max_ci_width, confidence)
+    if error is not None:
+        return JSONResponse(error, status_code=400)
+    if not app.video_jobs.reserve():
+        return JSONResponse('Too many video jobs, retry later', status_code=503,
+                            headers={'Retry-After': str(inference_retry_after)})
+    try:
+        with tempfile.NamedTemporaryFile(dir=video_jobs_dir, suffix='.mp4', delete=False) as spool:
+            try:
+                await spool_upload(request, spool)
+            except BaseException:
+                os.remove(spool.name)
+                raise
+    except BaseException:
+        app.video_jobs.release()
+        raise
+    job = VideoJob(user_id, baseline_embedding, id_threshold, spool.name,
+                   sampling={'stride': stride, 'fps': fps, 'keyframes': keyframes},
+                   scoring={'max_ci_width': max_ci_width, 'confidence': confidence})
+    app.video_jobs.submit(job)
+    return video_job_result(job)
+
+def video_job_result(job):
+    stats = job.stats()
+    pct_present, avg_distance, std_distance = stats if stats is not None else (None, None, None)
+    result = None
+    if job.status == 'done' and stats is not None:
+        result = SessionResult(session_id=None, user_id=job.user_id, pct_present=pct_present,
+                               avg_distance=avg_distance, std_distance=std_distance)
+    return VideoJobResult(
+      job_id=job.job_id,
+      user_id=job.user_id,
+      status=job.status,
+      frames_scored=len(job.frames),
+      early_exit=job.early_exit,
+      pct_present=pct_present,
+      avg_distance=avg_distance,
+      std_distance=std_distance,
+      result=result,
+      error=job.error
+    )
+
+@app.get("/video-jobs/{job_id}")
+async def get_video_job(job_id: str):
+    job = app.video_jobs.get(job_id)
+    if job is None:
+        return 'Video job not found'
+    return video_job_result(job)
+
+@app.delete("/video-jobs/{job_id}")
+async def cancel_video_job(job_id: str):
+    job = app.video_jobs.get(job_id)
+    if job is None:
+        return 'Video job not found'
+    if app.video_jobs.cancel(job):
+        return 'Video job cancelled'
+    return 'Video job already finished'
 
 @app.put("/users/{user_id}")
 async def set_user_image(user_id: int, file: bytes = File(...)):
-    # Convert file bytes to RGB numpy array
-    img_array = cv2.imdecode(np.frombuffer(file, dtype=np.uint8), cv2.IMREAD_COLOR)
-    id_face_embeddings = face_recognition.face_encodings(img_array)
+    _, id_face_embeddings = await encode_upload(file, 'enroll')
     # Ensure only one face is found in the photo
     if len(id_face_embeddings) == 1:
         id_face_embedding = id_face_embeddings[0].tolist()
         # Insert the user's face encoding into the database
-        chroma_collection.add(ids=[str(user_id)], embeddings=[id_face_embedding])
-        return 'User image embedding successfully added to the database'
-    elif len(id_face_embeddings) == 0:
-        return 'No face found in the photo'
+        with stage_timer('add', chroma_seconds):
+            chroma_collection.add(ids=[str(user_id)], embeddings=[id_face_embedding])
+        # chroma keeps the first embedding added for an id, so re-read it before indexing
+        app.embeddings.delete(user_id)
+        # Index writes can wait on another worker's gallery compaction, so they run in a worker thread
+        await asyncio.to_thread(app.search.add, [str(user_id)], [app.embeddings.get(user_id)])
+    return face_count_message(len(id_face_embeddings))
+
+async def spool_upload(request: Request, spool):
+    # Copy the multipart `file` field or the raw (possibly chunked) body to disk, so memory stays
+    # flat no matter how large the upload is
+    if request.headers.get('content-type', '').startswith('multipart/form-data'):
+        # Copied out because the form's own spool is closed once this handler returns
+        form = await request.form()
+        await asyncio.to_thread(shutil.copyfileobj, form['file'].file, spool)
     else:
-        return 'More than one face found in the photo'
+        async for chunk in request.stream():
+            spool.write(chunk)
+    spool.flush()
+
+async def spool_bulk_upload(request: Request):
+    # Spool the NDJSON manifest or zip/tar archive to disk before enrolling
+    content_type = request.headers.get('content-type', '')
+    spool = tempfile.TemporaryFile()
+    await spool_upload(request, spool)
+    spool.seek(0)
+    if content_type.startswith(('application/x-ndjson', 'application/jsonl')):
+        return iter_manifest(spool)
+    return iter_archive(spool)
+
+def write_enrollments(batch):
+    # Runs in a worker thread. Entries resolving to the same user (e.g. 104.jpg and dir/104.jpg)
+    # can't share an upsert, so the last one wins as it would across batches
+    latest = dict(batch)
+    ids = [str(user_id) for user_id in latest]
+    embeddings = list(latest.values())
+    # One batched upsert per chunk of users; bulk sync replaces existing photos
+    with stage_timer('upsert', chroma_seconds):
+        chroma_collection.upsert(ids=ids, embeddings=[embedding.tolist() for embedding in embeddings])
+    app.search.add(ids, embeddings)
+
+@app.post("/users/bulk")
+async def bulk_enroll_users(request: Request, job_id: str | None = None):
+    job_id = job_id or uuid.uuid4().hex
+    if not job_id_pattern.fullmatch(job_id):
+        return JSONResponse('job_id may only contain letters, digits, _ and -', status_code=400)
+    entries = await spool_bulk_upload(request)
+    journal = await asyncio.to_thread(EnrollmentJournal, job_id)
+    progress = EnrollmentProgress(resumed=len(journal.done))
+
+    async def enroll():
+        yield json.dumps({'job_id': job_id}) + '\n'
+        in_flight = deque()
+        batch, batch_statuses = [], []
+
+        async def flush():
+            # The upsert, index write and journal fsync all block, so they run in a worker thread
+            if batch:
+                await asyncio.to_thread(write_enrollments, batch)
+                for user_id, _ in batch:
+                    app.embeddings.delete(user_id)
+                await asyncio.to_thread(journal.record, batch_statuses)
+                progress.enrolled += len(batch)
+            lines = [json.dumps(status) + '\n' for status in batch_statuses]
+            batch.clear()
+            batch_statuses.clear()
+            return lines
+
+        async def finish(user_id, name, task):
+            try:
+                _, embeddings = await task
+            except Exception:
+                embeddings = None
+            progress.processed += 1
+            if embeddings is None:
+                status = {'user_id': user_id, 'file': name, 'status': 'Could not read image'}
+            else:
+                status = {'user_id': user_id, 'file': name, 'status': face_count_message(len(embeddings))}
+                if len(embeddings) == 1:
+                    # Reported once the batch holding it has been written
+                    batch.append((user_id, embeddings[0]))
+                    batch_statuses.append(status)
+                    return await flush() if len(batch) >= bulk_batch_size else []
+            progress.rejected += 1
+            await asyncio.to_thread(journal.record, [status])
+            return [json.dumps(status) + '\n']
+
+        try:
+            while True:
+                # Reading and decompressing the next entry blocks on the spooled upload
+                entry = await asyncio.to_thread(next, entries, None)
+                if entry is None:
+                    break
+                user_id, name, data = entry
+                if data is None:
+                    # A manifest line that could not be parsed; name holds its line number
+                    yield json.dumps({'user_id': None, 'error': f'Invalid manifest line {name}'}) + '\n'
+                    continue
+                if user_id is None:
+                    yield json.dumps({'user_id': None, 'file': name, 'status': 'Invalid user ID'}) + '\n'
+                    continue
+                if user_id in journal.done:
+                    continue
+                # Encode across every worker, keeping a bounded number of images in flight
+                in_flight.append((user_id, name, asyncio.ensure_future(encode_upload(data, 'enroll', block=True))))
+                while len(in_flight) >= 2 * inference_workers or (in_flight and in_flight[0][2].done()):
+                    for line in await finish(*in_flight.popleft()):
+                        yield line
+                if progress.due():
+                    yield json.dumps(progress.report()) + '\n'
+            while in_flight:
+                for line in await finish(*in_flight.popleft()):
+                    yield line
+            for line in await flush():
+                yield line
+            yield json.dumps(progress.report()) + '\n'
+        finally:
+            for _, _, task in in_flight:
+                task.cancel()
+            journal.close()
+
+    return StreamingResponse(enroll(), media_type='application/x-ndjson')
 
 @app.delete("/users/{user_id}")
 async def delete_user(user_id: int):
     # Delete the user's face encoding from the database
-    chroma_collection.delete(ids=[str(user_id)])
+    with stage_timer('delete', chroma_seconds):
+        chroma_collection.delete(ids=[str(user_id)])
+    app.embeddings.delete(user_id)
+    await asyncio.to_thread(app.search.remove, [str(user_id)])
     return 'User successfully deleted'
 
 @app.delete("/users/{user_id}")
 async def delete_user(user_id: int):
     # Delete the user's face encoding from the database
-    chroma_collection.delete(ids=[str(user_id)])
+    with stage_timer('delete', chroma_seconds):
+        chroma_collection.delete(ids=[str(user_id)])
+    app.embeddings.delete(user_id)
+    await asyncio.to_thread(app.search.remove, [str(user_id)])
     return 'User successfully deleted'
 
+@app.get("/ready")
+async def ready():
+    # Readiness probe: 503 until the lifespan hook has loaded the database and warmed up inference
+    if app.ready:
+        return 'Ready'
+    return JSONResponse('Starting', status_code=503)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return render_metrics()
+
 @app.get("/", response_class=PlainTextResponse)
 async def root():
     return """
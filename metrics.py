@@ -0,0 +1,194 @@
+import contextlib
+import contextvars
+import cProfile
+import os
+import random
+import threading
+import time
+
+# Minimal in-process metrics rendered in the Prometheus text exposition format
+registry = {}
+
+# Per-stage timing; with METRICS_ENABLED=0 timers are a shared no-op and no middleware is installed
+metrics_enabled = os.environ.get('METRICS_ENABLED', '1') != '0'
+# Requests can be profiled with cProfile when this directory is set: any request carrying an
+# X-Profile header, plus a random PROFILE_SAMPLE_RATE fraction of all requests
+profile_dir = os.environ.get('PROFILE_DIR')
+profile_sample_rate = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+
+latency_buckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels='', register=True):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        # Pre-rendered label pairs, e.g. 'stage="decode"', for histograms that belong to a family
+        self.labels = labels
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        # Observations can come from inference worker threads
+        self.lock = threading.Lock()
+        if register:
+            registry[name] = self
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += value
+
+    def render(self):
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram'] + self.samples())
+
+    def samples(self):
+        prefix = self.labels + ',' if self.labels else ''
+        suffix = '{' + self.labels + '}' if self.labels else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum{suffix} {self.sum}')
+        lines.append(f'{self.name}_count{suffix} {self.count}')
+        return lines
+
+class HistogramFamily:
+    # One histogram per value of a single label, rendered under one metric name
+    def __init__(self, name, help, label, buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.children = {}
+        self.lock = threading.Lock()
+        registry[name] = self
+
+    def labels(self, value):
+        child = self.children.get(value)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(value, Histogram(self.name, self.help, self.buckets,
+                                                                  f'{self.label}="{value}"', register=False))
+        return child
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for child in list(self.children.values()):
+            lines.extend(child.samples())
+        return '\n'.join(lines)
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+        registry[name] = self
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter',
+                          f'{self.name} {self.value}'])
+
+class Gauge:
+    # Reads its value from a callback at render time, so hot paths pay nothing to keep it current
+    def __init__(self, name, help, callback):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        registry[name] = self
+
+    def render(self):
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge',
+                          f'{self.name} {self.callback()}'])
+
+stage_seconds = HistogramFamily('stage_duration_seconds', 'Time spent in each stage of request handling',
+                                'stage', latency_buckets)
+request_seconds = HistogramFamily('http_request_duration_seconds', 'Request latency by route', 'route',
+                                  latency_buckets)
+chroma_seconds = HistogramFamily('chroma_call_duration_seconds', 'Latency of calls to the chroma database',
+                                 'operation', latency_buckets)
+
+class StageTimer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+no_timer = contextlib.nullcontext()
+# Set by the middleware so handlers can tell how long the request took to arrive and be parsed
+request_start = contextvars.ContextVar('request_start', default=None)
+
+def stage_timer(stage, family=stage_seconds):
+    # `with stage_timer('decode'):` records the block's duration under that stage label
+    if not metrics_enabled:
+        return no_timer
+    return StageTimer(family.labels(stage))
+
+class InstrumentationMiddleware:
+    # Plain ASGI middleware timing each HTTP request by route template, the time spent receiving
+    # and parsing the body (up to the endpoint being called), and optionally profiling it
+    def __init__(self, app):
+        self.app = app
+        # cProfile can only have one profiler active per thread
+        self.profiling = False
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        request_start.set(start)
+        profiler = self.start_profile(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            if metrics_enabled:
+                request_seconds.labels(route).observe(time.perf_counter() - start)
+            if profiler is not None:
+                self.finish_profile(profiler, route)
+
+    def start_profile(self, scope):
+        # The profiler sees everything the event loop runs meanwhile, not only this request
+        if profile_dir is None or self.profiling:
+            return None
+        requested = any(name == b'x-profile' for name, _ in scope.get('headers', ()))
+        if not requested and not (profile_sample_rate and random.random() < profile_sample_rate):
+            return None
+        self.profiling = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def finish_profile(self, profiler, route):
+        # Only event loop time is captured; work on the inference pool shows up as time awaiting it
+        profiler.disable()
+        self.profiling = False
+        os.makedirs(profile_dir, exist_ok=True)
+        name = route.strip('/').replace('/', '_').replace('{', '').replace('}', '') or 'root'
+        profiler.dump_stats(os.path.join(profile_dir, f'{name}-{time.time_ns()}.prof'))
+
+async def mark_body_parsed():
+    # Installed as an app-wide dependency, which FastAPI resolves once the body has been parsed
+    start = request_start.get()
+    if start is not None:
+        stage_seconds.labels('receive_and_parse').observe(time.perf_counter() - start)
+
+def render_metrics():
+    return '\n'.join(metric.render() for metric in registry.values()) + '\n'
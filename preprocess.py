@@ -0,0 +1,177 @@
+from typing import NamedTuple
+import os
+import struct
+
+import cv2
+import numpy as np
+
+from metrics import Counter
+
+class DetectorConfig(NamedTuple):
+    # 'hog' or 'cnn'
+    model: str = 'hog'
+    num_jitters: int = 1
+    upsample: int = 1
+    # 1, 2, 4 or 8: let libjpeg decode straight to a reduced resolution
+    decode_scale: int = 1
+    # Run detection on a copy resized to this width (0 keeps full size); encoding still uses the decoded image
+    detector_width: int = 0
+    # Above 0, look for the face inside the previous frame's face box grown by this fraction of its
+    # size, falling back to a full-frame detect when it isn't found there
+    roi_margin: float = 0.0
+
+# The defaults reproduce the original full-resolution HOG path. Each endpoint can be tuned
+# separately, e.g. DETECTOR_SESSIONS="decode_scale=2,roi_margin=0.5" or DETECTOR_ENROLL="model=cnn,num_jitters=5"
+detector_endpoints = ['sessions', 'search', 'image_distance', 'video_distance', 'enroll']
+
+# Frames whose 64-bit difference hash is within this many bits of the last encoded frame in the
+# session reuse its result instead of running dlib (-1 disables the check)
+dedup_threshold = int(os.environ.get('DEDUP_THRESHOLD', -1))
+# Force a real encode after this many consecutive reused frames so the result can't drift
+dedup_max_skipped = int(os.environ.get('DEDUP_MAX_SKIPPED', 10))
+
+roi_hits = Counter('roi_tracking_hits_total', 'Frames whose face was found inside the tracked region')
+roi_misses = Counter('roi_tracking_misses_total', 'Frames that fell back to a full-frame detect')
+
+reduced_decode_flags = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# Clients that already hold decoded frames can skip JPEG entirely. A raw upload is a 16-byte
+# little-endian header followed by the payload, which is wrapped in place without copying:
+#   frames:     b'RAWF', uint32 width, uint32 height, uint8 pixel format, 3 pad bytes, then uint8 pixels
+#   embeddings: b'RAWE', uint32 count, 8 pad bytes, then count x 128 float32
+raw_frame_magic = b'RAWF'
+raw_embedding_magic = b'RAWE'
+raw_frame_header = struct.Struct('<4sIIB3x')
+raw_embedding_header = struct.Struct('<4sI8x')
+# Header pixel format -> channels. BGR is what cv2.imdecode produces, so it matches the JPEG path
+# exactly and is used as-is; gray and RGB are converted first.
+raw_pixel_formats = {0: 1, 1: 3, 2: 3}
+raw_gray, raw_bgr, raw_rgb = 0, 1, 2
+
+class RawUploadError(ValueError):
+    pass
+
+def face_models():
+    # face_recognition loads every dlib model when it is imported, which takes seconds, so the
+    # import waits for the first detection unless startup.load_models() ran earlier
+    import face_recognition
+    return face_recognition
+
+def parse_detector_config(spec):
+    fields = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, value = item.split('=', 1)
+        fields[name] = type(DetectorConfig._field_defaults[name])(value)
+    config = DetectorConfig(**fields)
+    if config.model not in ('hog', 'cnn'):
+        raise ValueError(f'Unknown detector model {config.model}')
+    if config.decode_scale not in reduced_decode_flags:
+        raise ValueError(f'decode_scale must be one of {sorted(reduced_decode_flags)}')
+    return config
+
+detector_configs = {endpoint: parse_detector_config(os.environ.get(f'DETECTOR_{endpoint.upper()}', ''))
+                    for endpoint in detector_endpoints}
+
+def decode(file, config):
+    if file[:4] == raw_frame_magic:
+        # Already decoded, so decode_scale doesn't apply
+        return raw_frame(file)
+    return cv2.imdecode(np.frombuffer(file, dtype=np.uint8), reduced_decode_flags[config.decode_scale])
+
+def raw_frame(file):
+    if len(file) < raw_frame_header.size:
+        raise RawUploadError('Raw frame header is truncated')
+    _, width, height, pixel_format = raw_frame_header.unpack_from(file)
+    channels = raw_pixel_formats.get(pixel_format)
+    if channels is None:
+        raise RawUploadError(f'Unknown raw pixel format {pixel_format}')
+    if len(file) != raw_frame_header.size + width * height * channels:
+        raise RawUploadError(f'Raw frame should have {width}x{height}x{channels} pixels')
+    pixels = np.frombuffer(file, dtype=np.uint8, offset=raw_frame_header.size).reshape(height, width, channels)
+    if pixel_format == raw_gray:
+        # dlib's encoder needs three channels
+        return cv2.cvtColor(pixels, cv2.COLOR_GRAY2BGR)
+    if pixel_format == raw_rgb:
+        return cv2.cvtColor(pixels, cv2.COLOR_RGB2BGR)
+    return pixels
+
+def is_raw_embeddings(file):
+    return file[:4] == raw_embedding_magic
+
+def raw_embeddings(file, min_count=1):
+    # min_count=0 lets a session frame report that the client found no face
+    if len(file) < raw_embedding_header.size:
+        raise RawUploadError('Raw embedding header is truncated')
+    _, count = raw_embedding_header.unpack_from(file)
+    if count < min_count:
+        raise RawUploadError(f'Raw upload should hold at least {min_count} embedding(s)')
+    if len(file) != raw_embedding_header.size + count * 128 * 4:
+        raise RawUploadError(f'Raw upload should hold {count} embeddings of 128 float32')
+    return np.frombuffer(file, dtype='<f4', offset=raw_embedding_header.size).reshape(count, 128)
+
+def detect(image, config, roi=None):
+    if roi is not None and config.roi_margin > 0:
+        top, right, bottom, left = expand_box(roi, config.roi_margin, image.shape)
+        # dlib needs a contiguous buffer
+        locations = detect_full(np.ascontiguousarray(image[top:bottom, left:right]), config)
+        if locations:
+            roi_hits.inc()
+            return [(t + top, r + left, b + top, l + left) for t, r, b, l in locations]
+        roi_misses.inc()
+    return detect_full(image, config)
+
+def detect_full(image, config):
+    height, width = image.shape[:2]
+    if not config.detector_width or width <= config.detector_width:
+        return face_models().face_locations(image, number_of_times_to_upsample=config.upsample,
+                                               model=config.model)
+    scale = width / config.detector_width
+    small = cv2.resize(image, (config.detector_width, round(height / scale)), interpolation=cv2.INTER_AREA)
+    locations = face_models().face_locations(small, number_of_times_to_upsample=config.upsample,
+                                                model=config.model)
+    # Map the boxes back onto the decoded image
+    return [(max(0, round(t * scale)), min(width, round(r * scale)), min(height, round(b * scale)), max(0, round(l * scale)))
+            for t, r, b, l in locations]
+
+def encode(image, locations, config):
+    return face_models().face_encodings(image, known_face_locations=locations, num_jitters=config.num_jitters)
+
+def expand_box(box, margin, shape):
+    top, right, bottom, left = box
+    grow_y = round((bottom - top) * margin)
+    grow_x = round((right - left) * margin)
+    return (max(0, top - grow_y), min(shape[1], right + grow_x),
+            min(shape[0], bottom + grow_y), max(0, left - grow_x))
+
+def bounding_box(locations):
+    # Box around every face found, used as the next frame's region of interest
+    if not locations:
+        return None
+    return (min(t for t, _, _, _ in locations), max(r for _, r, _, _ in locations),
+            max(b for _, _, b, _ in locations), min(l for _, _, _, l in locations))
+
+def frame_hash(image):
+    # Difference hash: compare neighbouring pixels of a 9x8 grayscale thumbnail
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    return int.from_bytes(np.packbits(small[:, 1:] > small[:, :-1]).tobytes(), 'big')
+
+def hash_distance(a, b):
+    return (a ^ b).bit_count()
+
+class FrameHint:
+    # What the last encoded frame of a session looked like, kept per process
+    __slots__ = ('box', 'frame_hash', 'locations', 'embeddings', 'skipped')
+
+    def __init__(self, locations, embeddings, frame_hash):
+        self.box = bounding_box(locations)
+        self.frame_hash = frame_hash
+        self.locations = locations
+        self.embeddings = embeddings
+        # Consecutive frames that reused this result
+        self.skipped = 0
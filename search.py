@@ -0,0 +1,464 @@
+import math
+import os
+import tempfile
+import threading
+import uuid
+
+import numpy as np
+
+from embedding_store import embedding_dim
+
+# 'exact' (brute-force matmul), 'ivf' (approximate inverted-file index), 'quantized' (int8/float16
+# memory-mapped gallery, see gallery.py) or 'chroma'
+search_backend = os.environ.get('SEARCH_BACKEND', 'exact')
+# Directory for the embedding matrix's backing file, so large galleries are paged by the OS instead of
+# held in RAM. Every worker maps its own unlinked temporary file there, deleted when it exits.
+search_index_dir = os.environ.get('SEARCH_INDEX_DIR', 'chroma')
+# Log of enrolments and deletions shared by the workers, so each one's index follows the others' writes
+search_journal_path = os.environ.get('SEARCH_JOURNAL_PATH', os.path.join('chroma', 'search_journal.log'))
+# The log is emptied once it grows past this size, and every worker then reloads its index from the database
+search_journal_max_bytes = int(os.environ.get('SEARCH_JOURNAL_MAX_BYTES', 16 * 1024 * 1024))
+# Inverted lists probed per query; higher trades latency for recall
+ivf_n_probe = int(os.environ.get('IVF_N_PROBE', 8))
+# Below this many users the IVF index just does an exact search
+ivf_min_train_size = int(os.environ.get('IVF_MIN_TRAIN_SIZE', 1024))
+
+# Rows scored per matmul block, bounding the (queries x block) scratch matrix
+search_block_size = 65536
+
+# Every backend returns (ids, distances): one list of ids and one array of distances per query,
+# nearest first, with distances in the same euclidean/2 metric used throughout main.py
+
+def squared_distances(queries, matrix, norms):
+    # ||q - x||^2 = ||q||^2 + ||x||^2 - 2 q.x, as a single BLAS matmul
+    d2 = norms[None, :] - 2 * (queries @ matrix.T)
+    d2 += np.einsum('ij,ij->i', queries, queries)[:, None]
+    return d2
+
+def top_k(d2, k):
+    k = min(k, d2.shape[1])
+    if k == 0:
+        return np.zeros((len(d2), 0), dtype=np.int64)
+    idx = np.argpartition(d2, k - 1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(d2, idx, axis=1), axis=1)
+    return np.take_along_axis(idx, order, axis=1)
+
+class ExactSearch:
+    def __init__(self, directory=None, capacity=1024):
+        # Anonymous to every other process, so no one else can resize or write it
+        self.file = tempfile.TemporaryFile(dir=directory) if directory is not None else None
+        self.ids = []
+        self.rows = {}
+        self.matrix = self.allocate(capacity)
+        self.norms = np.zeros(capacity, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def allocate(self, capacity):
+        if self.file is None:
+            return np.zeros((capacity, embedding_dim), dtype=np.float32)
+        # Only ever grown, never shrunk under a live mapping
+        size = capacity * embedding_dim * 4
+        if os.fstat(self.file.fileno()).st_size < size:
+            self.file.truncate(size)
+        return np.memmap(self.file, dtype=np.float32, mode='r+', shape=(capacity, embedding_dim))
+
+    def grow(self, capacity):
+        if self.file is None:
+            matrix = self.allocate(capacity)
+            matrix[:len(self.matrix)] = self.matrix
+        else:
+            # The file is grown in place and re-mapped
+            self.matrix.flush()
+            del self.matrix
+            matrix = self.allocate(capacity)
+        norms = np.zeros(capacity, dtype=np.float32)
+        norms[:len(self.norms)] = self.norms
+        self.matrix, self.norms = matrix, norms
+
+    def add(self, ids, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, embedding_dim)
+        for user_id, embedding in zip(ids, embeddings):
+            row = self.rows.get(user_id)
+            if row is None:
+                row = len(self.ids)
+                if row == len(self.matrix):
+                    self.grow(2 * len(self.matrix))
+                self.ids.append(user_id)
+                self.rows[user_id] = row
+            self.matrix[row] = embedding
+            self.norms[row] = embedding @ embedding
+
+    def remove(self, ids):
+        moved = []
+        for user_id in ids:
+            row = self.rows.pop(user_id, None)
+            if row is None:
+                continue
+            # Swap the last row into the hole to keep the matrix dense
+            last = len(self.ids) - 1
+            last_id = self.ids.pop()
+            if row != last:
+                self.ids[row] = last_id
+                self.rows[last_id] = row
+                self.matrix[row] = self.matrix[last]
+                self.norms[row] = self.norms[last]
+                moved.append((last, row))
+        return moved
+
+    def search(self, queries, k):
+        return self.search_rows(queries, k)
+
+    def search_rows(self, queries, k, candidates=None):
+        # Exact top-k over all rows (or a subset of them), scored a block at a time
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, embedding_dim)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_d2 = np.zeros((len(queries), 0), dtype=np.float32)
+        n = len(self.ids) if candidates is None else len(candidates)
+        for start in range(0, n, search_block_size):
+            if candidates is None:
+                # Contiguous slices avoid copying the block out of the matrix
+                block = np.arange(start, min(start + search_block_size, n))
+                d2 = squared_distances(queries, self.matrix[start:start + len(block)], self.norms[start:start + len(block)])
+            else:
+                block = candidates[start:start + search_block_size]
+                d2 = squared_distances(queries, self.matrix[block], self.norms[block])
+            idx = top_k(d2, k)
+            rows = np.concatenate([best_rows, block[idx]], axis=1)
+            d2 = np.concatenate([best_d2, np.take_along_axis(d2, idx, axis=1)], axis=1)
+            idx = top_k(d2, k)
+            best_rows = np.take_along_axis(rows, idx, axis=1)
+            best_d2 = np.take_along_axis(d2, idx, axis=1)
+        return self.results(queries, best_rows)
+
+    def results(self, queries, rows):
+        # Re-score the winners directly so an exact match comes back as exactly 0
+        distances = np.linalg.norm(self.matrix[rows] - queries[:, None, :].astype(np.float64), axis=2) / 2
+        ids = [[self.ids[row] for row in query_rows] for query_rows in rows]
+        return ids, distances
+
+def kmeans(data, k, iterations=10, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = nearest_centroid(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        counts = np.bincount(assign, minlength=k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+def nearest_centroid(data, centroids):
+    norms = np.einsum('ij,ij->i', centroids, centroids)
+    return np.concatenate([
+        np.argmin(squared_distances(data[start:start + search_block_size], centroids, norms), axis=1)
+        for start in range(0, len(data), search_block_size)
+    ]) if len(data) else np.zeros(0, dtype=np.int64)
+
+class IVFSearch:
+    # Approximate search: k-means partitions the gallery into sqrt(n) lists and each query
+    # only scores the rows in its n_probe nearest lists
+    def __init__(self, directory=None, n_probe=ivf_n_probe, min_train_size=ivf_min_train_size):
+        self.exact = ExactSearch(directory)
+        self.n_probe = n_probe
+        self.min_train_size = min_train_size
+        self.centroids = None
+        self.trained_size = 0
+        self.assign = np.zeros(0, dtype=np.int64)
+        self.lists = None
+        # Retraining runs on a background thread, which swaps its centroids in under the lock
+        self.lock = threading.RLock()
+        self.training = None
+        # Bumped whenever removes move rows, which invalidates an assignment computed meanwhile
+        self.removals = 0
+
+    def __len__(self):
+        return len(self.exact)
+
+    def add(self, ids, embeddings):
+        with self.lock:
+            self.exact.add(ids, embeddings)
+            if self.lists is None:
+                return
+            # New rows join their nearest existing list; rows updated in place keep their old
+            # list, which only costs a little recall
+            start = len(self.assign)
+            self.assign_new_rows()
+            rows = np.arange(start, len(self.assign))
+            new = self.assign[start:]
+            for probe in np.unique(new):
+                self.lists[probe] = np.concatenate([self.lists[probe], rows[new == probe]])
+            self.maybe_retrain()
+
+    def remove(self, ids):
+        with self.lock:
+            for old_row, new_row in self.exact.remove(ids):
+                if old_row < len(self.assign):
+                    self.assign[new_row] = self.assign[old_row]
+                else:
+                    # The moved row was never assigned, so reassign from here on
+                    self.assign = self.assign[:new_row]
+            self.assign = self.assign[:len(self.exact)]
+            self.removals += 1
+            if self.lists is not None:
+                self.assign_new_rows()
+                self.index_lists()
+
+    def train(self, data):
+        # (centroids, list of every row of data) for sqrt(n) lists
+        n = len(data)
+        sample = data[np.random.default_rng(0).choice(n, min(n, 64 * int(math.sqrt(n))), replace=False)]
+        centroids = kmeans(sample, max(1, int(math.sqrt(n))))
+        return centroids, nearest_centroid(data, centroids)
+
+    def assign_new_rows(self):
+        n = len(self.exact)
+        if len(self.assign) < n:
+            new = np.asarray(self.exact.matrix[len(self.assign):n])
+            self.assign = np.concatenate([self.assign, nearest_centroid(new, self.centroids)])
+
+    def index_lists(self):
+        assign = self.assign[:len(self.exact)]
+        order = np.argsort(assign, kind='stable')
+        bounds = np.searchsorted(assign[order], np.arange(len(self.centroids) + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+
+    def build_lists(self):
+        # Trains on the calling thread; only needed once, later retraining happens in the background
+        with self.lock:
+            if len(self.exact) == 0:
+                return
+            self.centroids, self.assign = self.train(np.asarray(self.exact.matrix[:len(self.exact)]))
+            self.trained_size = len(self.assign)
+            self.index_lists()
+
+    def maybe_retrain(self):
+        # Retrain once the gallery has doubled since the last training
+        if self.training is None and len(self.exact) > 2 * self.trained_size:
+            self.training = threading.Thread(target=self.retrain, name='ivf-training', daemon=True)
+            self.training.start()
+
+    def retrain(self):
+        try:
+            with self.lock:
+                data = np.array(self.exact.matrix[:len(self.exact)])
+                removals = self.removals
+            # Searches keep using the current lists while k-means runs
+            centroids, assign = self.train(data)
+            with self.lock:
+                if self.removals != removals:
+                    # Rows moved while training, so assign them all again
+                    assign = nearest_centroid(np.asarray(self.exact.matrix[:len(self.exact)]), centroids)
+                self.centroids, self.assign, self.trained_size = centroids, assign, len(data)
+                # Rows added while training
+                self.assign_new_rows()
+                self.index_lists()
+        finally:
+            self.training = None
+
+    def search(self, queries, k):
+        with self.lock:
+            if len(self.exact) < self.min_train_size:
+                return self.exact.search(queries, k)
+            if self.lists is None:
+                self.build_lists()
+            queries = np.asarray(queries, dtype=np.float32).reshape(-1, embedding_dim)
+            probes = top_k(squared_distances(queries, self.centroids,
+                                             np.einsum('ij,ij->i', self.centroids, self.centroids)),
+                           self.n_probe)
+            ids, distances = [], []
+            for query, query_probes in zip(queries, probes):
+                candidates = np.concatenate([self.lists[probe] for probe in query_probes])
+                query_ids, query_distances = self.exact.search_rows(query[None, :], k, candidates)
+                ids.append(query_ids[0])
+                distances.append(query_distances[0])
+            return ids, distances
+
+class ChromaSearch:
+    # Delegates to the collection's own index, converting its squared L2 to euclidean/2
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __len__(self):
+        return self.collection.count()
+
+    def add(self, ids, embeddings):
+        pass
+
+    def remove(self, ids):
+        pass
+
+    def search(self, queries, k):
+        db_result = self.collection.query(query_embeddings=np.asarray(queries).tolist(), n_results=k,
+                                          include=['distances'],)
+        distances = [np.sqrt(np.maximum(query_distances, 0)) / 2 for query_distances in db_result["distances"]]
+        return db_result["ids"], distances
+
+class SearchJournal:
+    # Append-only log of "<writer> <add|remove> <id>" lines. Each line is written with a single
+    # O_APPEND write, so lines from different workers never interleave. Once it passes max_bytes
+    # the log is replaced by an empty file; readers notice the new inode and reload from the database.
+    def __init__(self, path, max_bytes=search_journal_max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.writer = uuid.uuid4().hex[:8]
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        open(path, 'ab').close()
+        # Taken before the index is loaded, so writes made while loading are replayed too
+        stat = os.stat(path)
+        self.inode, self.offset = stat.st_ino, stat.st_size
+
+    def append(self, op, ids):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, ''.join(f'{self.writer} {op} {user_id}\n' for user_id in ids).encode())
+            rotate = os.fstat(fd).st_size >= self.max_bytes
+        finally:
+            os.close(fd)
+        if rotate:
+            # Lines written to the old file after this are lost, but every reader reloads anyway
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+            os.close(fd)
+            os.replace(temp, self.path)
+
+    def poll(self, own=False):
+        # (op, id) of the entries other workers (and this one too, if own) wrote since the last
+        # poll, or None if the log was replaced since, in which case entries may have been missed
+        stat = os.stat(self.path)
+        if stat.st_ino != self.inode:
+            # Taken before the index is reloaded, as in __init__
+            self.inode, self.offset = stat.st_ino, stat.st_size
+            return None
+        if stat.st_size <= self.offset:
+            return []
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # A line still being written is left for the next poll
+        data = data[:data.rfind(b'\n') + 1]
+        self.offset += len(data)
+        entries = [line.split(' ') for line in data.decode().splitlines()]
+        return [(op, user_id) for writer, op, user_id in entries if own or writer != self.writer]
+
+class SyncedSearch:
+    # A per-process index kept in step with the other workers' through a SearchJournal: writes are
+    # logged, and before each search the writes logged by others are replayed against the database.
+    # load returns a new index filled from the database; it is called again whenever the journal
+    # was replaced. Safe to call from several threads.
+    def __init__(self, load, journal, collection):
+        self.load = load
+        self.journal = journal
+        self.collection = collection
+        self.lock = threading.Lock()
+        self.reloading = False
+        self.backend = load()
+
+    def __len__(self):
+        self.catch_up()
+        return len(self.backend)
+
+    def add(self, ids, embeddings):
+        with self.lock:
+            self.backend.add(ids, embeddings)
+            self.journal.append('add', ids)
+
+    def remove(self, ids):
+        with self.lock:
+            self.backend.remove(ids)
+            self.journal.append('remove', ids)
+
+    def search(self, queries, k):
+        self.catch_up()
+        with self.lock:
+            return self.backend.search(queries, k)
+
+    def catch_up(self):
+        with self.lock:
+            if self.reloading:
+                # The current index serves searches until the reload is done
+                return
+            entries = self.journal.poll()
+            if entries is not None:
+                self.replay(self.backend, entries)
+                return
+            self.reloading = True
+        try:
+            while True:
+                # Reloaded outside the lock, then every write logged since the journal was replaced
+                # is replayed onto it, including this worker's own, which only reached the old index
+                backend = self.load()
+                with self.lock:
+                    entries = self.journal.poll(own=True)
+                    if entries is not None:
+                        self.replay(backend, entries)
+                        self.backend = backend
+                        return
+        finally:
+            self.reloading = False
+
+    def replay(self, backend, entries):
+        if not entries:
+            return
+        # Only the last write to each id matters, and for adds the database holds the current embedding
+        last = {user_id: op for op, user_id in entries}
+        added = [user_id for user_id, op in last.items() if op == 'add']
+        found = set()
+        if added:
+            db_result = self.collection.get(ids=added, include=['embeddings'])
+            backend.add(db_result["ids"], db_result["embeddings"])
+            found = set(db_result["ids"])
+        removed = [user_id for user_id in last if user_id not in found]
+        if removed:
+            backend.remove(removed)
+
+def load_collection(backend, collection, page_size=10000):
+    offset = 0
+    while True:
+        db_result = collection.get(include=['embeddings'], limit=page_size, offset=offset)
+        if len(db_result["ids"]) == 0:
+            break
+        backend.add(db_result["ids"], db_result["embeddings"])
+        offset += len(db_result["ids"])
+
+def sync_collection(backend, collection, page_size=10000):
+    # Bring a persistent index in line with the database, e.g. after users were enrolled or
+    # deleted while another backend was active: add the users it lacks and drop the ones the
+    # database no longer has. Only ids are paged through, so this is cheap when nothing changed.
+    indexed = backend.live_ids()
+    seen = set()
+    offset = 0
+    while True:
+        db_result = collection.get(include=[], limit=page_size, offset=offset)
+        if len(db_result["ids"]) == 0:
+            break
+        missing = [user_id for user_id in db_result["ids"] if user_id not in indexed]
+        if missing:
+            fetched = collection.get(ids=missing, include=['embeddings'])
+            backend.add(fetched["ids"], fetched["embeddings"])
+        seen.update(db_result["ids"])
+        offset += len(db_result["ids"])
+    stale = indexed - seen
+    if stale:
+        backend.remove(sorted(stale))
+
+def make_search_backend(kind, collection, directory=search_index_dir, journal_path=search_journal_path):
+    if kind == 'chroma':
+        return ChromaSearch(collection)
+    if kind == 'quantized':
+        # Imported here since gallery.py builds on this module
+        from gallery import QuantizedGallery
+        backend = QuantizedGallery()
+        # Unlike the scratch index below it persists, and the workers share it, so it is only
+        # brought up to date with the database rather than rebuilt
+        sync_collection(backend, collection)
+        return backend
+    def load():
+        backend = IVFSearch(directory) if kind == 'ivf' else ExactSearch(directory)
+        # The index is rebuilt from the database on startup, so the file is scratch space
+        load_collection(backend, collection)
+        if kind == 'ivf' and len(backend) >= backend.min_train_size:
+            backend.build_lists()
+        return backend
+    return SyncedSearch(load, SearchJournal(journal_path), collection)
@@ -0,0 +1,164 @@
+import argparse
+import json
+import os
+import threading
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+from metrics import Counter
+from sessions import frame_columns
+
+# Directory of the archive that deleted and evicted sessions are written to; unset disables archiving
+session_archive_path = os.environ.get('SESSION_ARCHIVE_PATH')
+# Archived frames are buffered in memory and appended to disk in batches of at least this many, by
+# write_due() (which the app runs from a worker thread every second) or flush()
+session_archive_batch_size = int(os.environ.get('SESSION_ARCHIVE_BATCH_SIZE', 4096))
+
+archived_sessions = Counter('session_archive_sessions_total', 'Sessions written to the session archive')
+
+class ArchiveSegment(NamedTuple):
+    # One row per archived session, in the order they were archived
+    session_ids: list
+    user_ids: np.ndarray
+    updated_at: np.ndarray
+    frame_counts: np.ndarray
+    # One row per frame: each session's frames in timestamp order, sessions in the order above
+    timestamps: np.ndarray
+    distances: np.ndarray
+
+def column_path(directory, name, dtype):
+    dtype = np.dtype(dtype)
+    return os.path.join(directory, f'{name}.{dtype.kind}{dtype.itemsize}')
+
+def map_column(directory, name, dtype):
+    path = column_path(directory, name, dtype)
+    count = os.path.getsize(path) // np.dtype(dtype).itemsize if os.path.exists(path) else 0
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+def read_segment(directory):
+    # Maps a segment's columns, dropping a batch torn by a crash: the session ids are written
+    # last, so only sessions with an id line and all of their frames on disk are returned
+    session_ids = []
+    path = os.path.join(directory, 'session_ids.jsonl')
+    if os.path.exists(path):
+        with open(path) as f:
+            session_ids = [json.loads(line) for line in f if line.endswith('\n')]
+    user_ids = map_column(directory, 'user_ids', np.int64)
+    updated_at = map_column(directory, 'updated_at', np.float64)
+    frame_counts = map_column(directory, 'frame_counts', np.int64)
+    timestamps = map_column(directory, 'timestamps', np.int64)
+    distances = map_column(directory, 'distances', np.float64)
+    n = min(len(session_ids), len(user_ids), len(updated_at), len(frame_counts))
+    n = min(n, int(np.searchsorted(np.cumsum(frame_counts[:n]), min(len(timestamps), len(distances)),
+                                   side='right')))
+    frames = int(frame_counts[:n].sum())
+    return ArchiveSegment(session_ids[:n], user_ids[:n], updated_at[:n], frame_counts[:n],
+                          timestamps[:frames], distances[:frames])
+
+class SessionArchive:
+    # Append-only columnar archive of finished sessions: the per-frame distances of every deleted
+    # or evicted session, kept so results can be recomputed later (e.g. under another threshold)
+    # without the frames being uploaded and encoded again. Every process appends to its own
+    # segment directory of flat column files, which readers memory-map.
+    def __init__(self, path=session_archive_path, batch_size=session_archive_batch_size):
+        self.path = path
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_frames = 0
+        # Created on the first flush; a process never appends to a segment written before it started
+        self.directory = None
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, session_id, session):
+        if len(session) == 0:
+            return
+        # Copies the frames, since the session may still be referenced (and mutated) elsewhere
+        record = (session_id, session.user_id, session.updated_at,
+                  np.array(session.timestamps, dtype=np.int64), np.array(session.distances, dtype=np.float64))
+        # Only buffered, since stores call this from the event loop; the files are written by
+        # write_due() and flush()
+        with self.lock:
+            self.pending.append(record)
+            self.pending_frames += len(record[3])
+
+    def write_due(self):
+        # Writes the buffered sessions once they fill a batch
+        with self.lock:
+            if self.pending_frames >= self.batch_size:
+                self.write()
+
+    def flush(self):
+        with self.lock:
+            self.write()
+
+    def write(self):
+        if not self.pending:
+            return
+        pending, self.pending, self.pending_frames = self.pending, [], 0
+        if self.directory is None:
+            self.directory = os.path.join(self.path, f'seg-{time.time_ns()}-{os.getpid()}')
+            os.makedirs(self.directory)
+        session_ids, user_ids, updated_at, timestamps, distances = zip(*pending)
+        try:
+            self.write_batch(session_ids, user_ids, updated_at, timestamps, distances)
+        except BaseException:
+            # A partly written batch would misalign the columns of the next one, so start a new segment
+            self.directory = None
+            raise
+        archived_sessions.inc(len(pending))
+
+    def write_batch(self, session_ids, user_ids, updated_at, timestamps, distances):
+        # Frames first and the session ids last, so a batch only becomes visible once complete
+        for name, values, dtype in (('timestamps', np.concatenate(timestamps), np.int64),
+                                    ('distances', np.concatenate(distances), np.float64),
+                                    ('frame_counts', [len(frames) for frames in distances], np.int64),
+                                    ('user_ids', user_ids, np.int64),
+                                    ('updated_at', updated_at, np.float64)):
+            with open(column_path(self.directory, name, dtype), 'ab') as f:
+                f.write(np.asarray(values, dtype=dtype).tobytes())
+        with open(os.path.join(self.directory, 'session_ids.jsonl'), 'a') as f:
+            f.write(''.join(json.dumps(session_id) + '\n' for session_id in session_ids))
+
+    def segments(self):
+        self.flush()
+        return [read_segment(os.path.join(self.path, name)) for name in sorted(os.listdir(self.path))
+                if name.startswith('seg-')]
+
+    def rescore(self, threshold, session_ids=None):
+        # SessionColumns of every archived session (or just the given ones) under a new presence
+        # threshold, computed in one vectorized pass over the archived distances
+        segments = self.segments()
+        ids = [session_id for segment in segments for session_id in segment.session_ids]
+        user_ids, updated_at, frame_counts, distances = (
+            np.concatenate([np.zeros(0, dtype=dtype)] + [getattr(segment, name) for segment in segments])
+            for name, dtype in (('user_ids', np.int64), ('updated_at', np.float64),
+                                ('frame_counts', np.int64), ('distances', np.float64)))
+        if session_ids is not None:
+            wanted = set(session_ids)
+            keep = np.fromiter((session_id in wanted for session_id in ids), dtype=bool, count=len(ids))
+            ids = [session_id for session_id, kept in zip(ids, keep.tolist()) if kept]
+            distances = distances[np.repeat(keep, frame_counts)]
+            user_ids, updated_at, frame_counts = user_ids[keep], updated_at[keep], frame_counts[keep]
+        return frame_columns(ids, user_ids, updated_at, frame_counts, distances, threshold)
+
+def main():
+    # Re-scores the archive from the command line, printing one SessionResult per line:
+    #   python session_archive.py --threshold 0.35 [--path chroma/archive] [--session-id ID ...]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threshold', type=float, required=True)
+    parser.add_argument('--path', default=session_archive_path, required=session_archive_path is None)
+    parser.add_argument('--session-id', action='append', dest='session_ids')
+    args = parser.parse_args()
+    columns = SessionArchive(args.path).rescore(args.threshold, args.session_ids)
+    for session_id, user_id, pct_present, avg_distance, std_distance in zip(
+            columns.session_ids, columns.user_ids.tolist(), *(values.tolist() for values in columns.stats())):
+        print(json.dumps({'session_id': session_id, 'user_id': user_id, 'pct_present': pct_present,
+                          'avg_distance': avg_distance, 'std_distance': std_distance}))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,395 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from lru import LRU
+import numpy as np
+
+from metrics import Counter, Gauge
+from sessions import Session, SessionColumns, frame_columns, session_cache_size, session_columns
+
+# 'memory' (per-process LRU), 'sqlite' (shared by the workers on one node) or 'redis' (shared by every node)
+session_backend = os.environ.get('SESSION_BACKEND', 'memory')
+# Sessions expire this many seconds after their last frame
+session_ttl = float(os.environ.get('SESSION_TTL', 3600))
+session_db_path = os.environ.get('SESSION_DB_PATH', os.path.join('chroma', 'sessions.sqlite3'))
+redis_url = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+# Frame appends are buffered and written in batches of this size (1 writes every frame immediately);
+# buffered frames are flushed before this process reads a session's frames or aggregates back, and
+# by the app at least once a second
+session_write_batch_size = int(os.environ.get('SESSION_WRITE_BATCH_SIZE', 1))
+
+session_evictions = Counter('session_store_evictions_total',
+                            'Sessions dropped by this process for exceeding the TTL or the cache size')
+
+# Every store offers get(session_id, frames=True), create(session_id, user_id, baseline_embedding),
+# append(session_id, timestamp, distance), delete(session_id), flush(), columns(session_ids=None),
+# purge_expired() (run periodically, at most once a minute) and close() (at shutdown).
+# get(frames=False) may skip loading the per-frame history when only the user and baseline are
+# needed; columns returns the aggregates of the given (or every live) session as SessionColumns.
+# Given a SessionArchive, a store hands it every session it deletes or evicts, frames included.
+# The SQLite and Redis stores block on I/O, so the app calls them from worker threads; they lock
+# around their own state.
+
+class MemorySessionStore:
+    def __init__(self, threshold, size=session_cache_size, ttl=session_ttl, archive=None):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.archive = archive
+        self.last_purge = 0.0
+        # The LRU bound stays as a memory safety net on top of the TTL
+        self.cache = LRU(size, callback=self.evicted)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def get(self, session_id, frames=True):
+        session = self.cache.get(session_id)
+        if session is not None and time.time() - session.updated_at > self.ttl:
+            del self.cache[session_id]
+            self.evicted(session_id, session)
+            return None
+        return session
+
+    def evicted(self, session_id, session):
+        session_evictions.inc()
+        if self.archive is not None:
+            self.archive.add(session_id, session)
+
+    def create(self, session_id, user_id, baseline_embedding):
+        session = Session(user_id, baseline_embedding, self.threshold)
+        self.cache[session_id] = session
+        return session
+
+    def append(self, session_id, timestamp, distance):
+        session = self.cache.get(session_id)
+        if session is None:
+            return False
+        session.add(timestamp, distance)
+        return True
+
+    def delete(self, session_id):
+        session = self.cache.get(session_id)
+        if session is None:
+            return False
+        del self.cache[session_id]
+        if self.archive is not None:
+            self.archive.add(session_id, session)
+        return True
+
+    def flush(self):
+        pass
+
+    def purge_expired(self):
+        # Sessions that stopped receiving frames are otherwise only dropped when read again or
+        # pushed out by the LRU bound
+        now = time.time()
+        if now - self.last_purge < 60:
+            return
+        self.last_purge = now
+        for session_id, session in [(session_id, session) for session_id, session in self.cache.items()
+                                    if now - session.updated_at > self.ttl]:
+            del self.cache[session_id]
+            self.evicted(session_id, session)
+
+    def close(self):
+        # The sessions die with this process, so archive what is left, once
+        if self.archive is not None:
+            for session_id, session in self.cache.items():
+                self.archive.add(session_id, session)
+        self.cache.clear()
+
+    def columns(self, session_ids=None):
+        now = time.time()
+        if session_ids is None:
+            items = self.cache.items()
+        else:
+            items = [(session_id, self.cache.get(session_id)) for session_id in session_ids]
+        return session_columns([(session_id, session) for session_id, session in items
+                                if session is not None and now - session.updated_at <= self.ttl])
+
+class SQLiteSessionStore:
+    # One WAL-mode database shared by every worker process on the node
+    def __init__(self, threshold, path=session_db_path, ttl=session_ttl, batch_size=session_write_batch_size,
+                 archive=None):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.archive = archive
+        self.lock = threading.RLock()
+        self.pending = []
+        # session_id -> time of its last buffered frame, which counts as activity for the TTL
+        self.pending_since = {}
+        self.last_purge = 0.0
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, user_id INTEGER, '
+                        'baseline BLOB, updated_at REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS frames (session_id TEXT, timestamp INTEGER, distance REAL, '
+                        'PRIMARY KEY (session_id, timestamp)) WITHOUT ROWID')
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT count(*) FROM sessions').fetchone()[0]
+
+    def get(self, session_id, frames=True):
+        with self.lock:
+            # The per-frame lookup only needs the user and baseline, so it leaves the write batch alone
+            if frames:
+                self.flush()
+            session = self.load(session_id, frames)
+            if session is None:
+                return None
+            if time.time() - max(session.updated_at, self.pending_since.get(session_id, 0)) > self.ttl:
+                self.delete(session_id)
+                return None
+            return session
+
+    def load(self, session_id, frames=True):
+        # The stored session, expired or not
+        row = self.db.execute('SELECT user_id, baseline, updated_at FROM sessions WHERE session_id = ?',
+                              (session_id,)).fetchone()
+        if row is None:
+            return None
+        user_id, baseline, updated_at = row
+        timestamps, distances = [], []
+        if frames:
+            rows = self.db.execute('SELECT timestamp, distance FROM frames WHERE session_id = ? ORDER BY timestamp',
+                                   (session_id,)).fetchall()
+            if rows:
+                timestamps, distances = zip(*rows)
+        return Session.from_frames(user_id, np.frombuffer(baseline, dtype=np.float32), self.threshold,
+                                   timestamps, distances, updated_at)
+
+    def create(self, session_id, user_id, baseline_embedding):
+        baseline = np.asarray(baseline_embedding, dtype=np.float32)
+        with self.lock:
+            self.purge_expired()
+            with self.transaction():
+                # Another worker may have created it first, in which case theirs wins
+                created = self.db.execute('INSERT OR IGNORE INTO sessions VALUES (?, ?, ?, ?)',
+                                          (session_id, user_id, baseline.tobytes(), time.time())).rowcount
+                if created:
+                    # Frames that an earlier session with this id may have left behind
+                    self.db.execute('DELETE FROM frames WHERE session_id = ?', (session_id,))
+            return self.get(session_id, frames=False)
+
+    def append(self, session_id, timestamp, distance):
+        with self.lock:
+            self.pending.append((session_id, timestamp, distance))
+            self.pending_since[session_id] = time.time()
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+        return True
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            pending, self.pending, self.pending_since = self.pending, [], {}
+            now = time.time()
+            # Frames and the sessions' last-update times are written in one transaction. Frames of a
+            # session deleted or purged since they were buffered are dropped rather than orphaned.
+            with self.transaction():
+                self.db.executemany('INSERT OR REPLACE INTO frames SELECT ?, ?, ? '
+                                    'WHERE EXISTS (SELECT 1 FROM sessions WHERE session_id = ?)',
+                                    [(session_id, timestamp, distance, session_id)
+                                     for session_id, timestamp, distance in pending])
+                self.db.executemany('UPDATE sessions SET updated_at = ? WHERE session_id = ?',
+                                    [(now, session_id) for session_id in {session_id for session_id, _, _ in pending}])
+
+    def delete(self, session_id):
+        with self.lock:
+            self.flush()
+            with self.transaction():
+                # Read inside the transaction so that of several workers deleting it, one archives it
+                session = self.load(session_id) if self.archive is not None else None
+                deleted = self.db.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,)).rowcount
+                self.db.execute('DELETE FROM frames WHERE session_id = ?', (session_id,))
+        if session is not None:
+            self.archive.add(session_id, session)
+        return deleted > 0
+
+    def columns(self, session_ids=None):
+        with self.lock:
+            self.flush()
+            return self.aggregate(session_ids)
+
+    def aggregate(self, session_ids):
+        # Aggregated by SQLite in grouped scans instead of loading each session's frames. m2 sums the
+        # squared deviations from each session's mean, taken first, rather than subtracting
+        # sum * mean from the sum of squares, which cancels badly when the distances are close
+        live = 'SELECT session_id, user_id, updated_at FROM sessions WHERE updated_at >= ?'
+        params = [time.time() - self.ttl]
+        if session_ids is not None:
+            live += ' AND session_id IN (SELECT value FROM json_each(?))'
+            params.append(json.dumps(list(session_ids)))
+        query = (f'WITH live AS ({live}), '
+                 'means AS (SELECT session_id, avg(distance) AS mean FROM frames JOIN live USING (session_id) '
+                 'GROUP BY session_id) '
+                 'SELECT l.session_id, l.user_id, l.updated_at, count(f.distance), total(f.distance <= ?), '
+                 'coalesce(m.mean, 0), total((f.distance - m.mean) * (f.distance - m.mean)) '
+                 'FROM live l LEFT JOIN means m USING (session_id) LEFT JOIN frames f USING (session_id) '
+                 'GROUP BY l.session_id')
+        rows = self.db.execute(query, params + [self.threshold]).fetchall()
+        if not rows:
+            return frame_columns([], [], [], [], [], self.threshold)
+        session_ids, user_ids, updated_at, counts, present, means, m2s = zip(*rows)
+        return SessionColumns(list(session_ids), np.array(user_ids, dtype=np.int64), np.array(counts, dtype=np.int64),
+                              np.array(present, dtype=np.int64), np.array(means, dtype=np.float64),
+                              np.array(m2s, dtype=np.float64), np.array(updated_at, dtype=np.float64))
+
+    def purge_expired(self):
+        now = time.time()
+        if now - self.last_purge < 60:
+            return
+        self.last_purge = now
+        with self.lock, self.transaction():
+            expired = []
+            if self.archive is not None:
+                expired = [(session_id, self.load(session_id)) for session_id, in self.db.execute(
+                    'SELECT session_id FROM sessions WHERE updated_at < ?', (now - self.ttl,)).fetchall()]
+            self.db.execute('DELETE FROM frames WHERE session_id IN '
+                            '(SELECT session_id FROM sessions WHERE updated_at < ?)', (now - self.ttl,))
+            purged = self.db.execute('DELETE FROM sessions WHERE updated_at < ?', (now - self.ttl,)).rowcount
+        session_evictions.inc(purged)
+        for session_id, session in expired:
+            self.archive.add(session_id, session)
+
+    def close(self):
+        # Sessions outlive the process in the database, so they are archived when they expire
+        self.flush()
+
+    def transaction(self):
+        return SQLiteTransaction(self.db)
+
+class SQLiteTransaction:
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+class RedisSessionStore:
+    # Works with redis-py or any client speaking the same commands. Each session is three keys
+    # expiring together: its user and baseline, a hash of timestamp -> distance, and its last-update time.
+    # Redis expires sessions on its own, so only deleted sessions reach the archive.
+    def __init__(self, threshold, client, ttl=session_ttl, batch_size=session_write_batch_size, archive=None):
+        self.threshold = threshold
+        self.client = client
+        self.ttl = int(ttl)
+        self.batch_size = batch_size
+        self.archive = archive
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def get(self, session_id, frames=True):
+        # The per-frame lookup only needs the user and baseline, so it leaves the write batch alone
+        if frames:
+            self.flush()
+        pipe = self.client.pipeline(transaction=True)
+        pipe.get(f'session:{session_id}')
+        pipe.get(f'session:{session_id}:updated_at')
+        if frames:
+            pipe.hgetall(f'session:{session_id}:frames')
+        meta, updated_at, *stored = pipe.execute()
+        if meta is None:
+            return None
+        timestamps, distances = [], []
+        if stored and stored[0]:
+            timestamps, distances = zip(*sorted((int(timestamp), float(distance))
+                                                for timestamp, distance in stored[0].items()))
+        return Session.from_frames(int(np.frombuffer(meta[:8], dtype=np.int64)[0]),
+                                   np.frombuffer(meta[8:], dtype=np.float32), self.threshold,
+                                   timestamps, distances, float(updated_at or 0))
+
+    def create(self, session_id, user_id, baseline_embedding):
+        meta = np.int64(user_id).tobytes() + np.asarray(baseline_embedding, dtype=np.float32).tobytes()
+        # SET NX makes creation first-writer-wins across nodes
+        if self.client.set(f'session:{session_id}', meta, nx=True, ex=self.ttl):
+            pipe = self.client.pipeline(transaction=True)
+            pipe.set(f'session:{session_id}:updated_at', time.time(), ex=self.ttl)
+            # Frames that late appends to an earlier session with this id may have left behind
+            pipe.delete(f'session:{session_id}:frames')
+            pipe.execute()
+        return self.get(session_id, frames=False)
+
+    def append(self, session_id, timestamp, distance):
+        with self.lock:
+            self.pending.append((session_id, timestamp, distance))
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.flush()
+        return True
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return
+        now = time.time()
+        # One MULTI/EXEC round trip for the whole batch
+        pipe = self.client.pipeline(transaction=True)
+        for session_id, timestamp, distance in pending:
+            pipe.hset(f'session:{session_id}:frames', str(timestamp), repr(float(distance)))
+        for session_id in {session_id for session_id, _, _ in pending}:
+            pipe.set(f'session:{session_id}:updated_at', now, ex=self.ttl)
+            pipe.expire(f'session:{session_id}', self.ttl)
+            pipe.expire(f'session:{session_id}:frames', self.ttl)
+        pipe.execute()
+
+    def columns(self, session_ids=None):
+        self.flush()
+        if session_ids is None:
+            session_ids = [key.decode()[len('session:'):-len(':updated_at')]
+                           for key in self.client.scan_iter(match='session:*:updated_at')]
+        pipe = self.client.pipeline(transaction=False)
+        for session_id in session_ids:
+            pipe.get(f'session:{session_id}')
+            pipe.get(f'session:{session_id}:updated_at')
+            pipe.hvals(f'session:{session_id}:frames')
+        replies = pipe.execute()
+        found = [(session_id, meta, updated_at, values) for session_id, meta, updated_at, values
+                 in zip(session_ids, replies[0::3], replies[1::3], replies[2::3]) if meta is not None]
+        return frame_columns([session_id for session_id, _, _, _ in found],
+                             [int(np.frombuffer(meta[:8], dtype=np.int64)[0]) for _, meta, _, _ in found],
+                             [float(updated_at or 0) for _, _, updated_at, _ in found],
+                             [len(values) for _, _, _, values in found],
+                             [float(value) for _, _, _, values in found for value in values],
+                             self.threshold)
+
+    def purge_expired(self):
+        # Redis expires the keys itself
+        pass
+
+    def close(self):
+        self.flush()
+
+    def delete(self, session_id):
+        self.flush()
+        session = self.get(session_id) if self.archive is not None else None
+        deleted = self.client.delete(f'session:{session_id}', f'session:{session_id}:frames',
+                                     f'session:{session_id}:updated_at') > 0
+        # Only the node whose delete went through archives the session
+        if deleted and session is not None:
+            self.archive.add(session_id, session)
+        return deleted
+
+def register_store_metrics(store, kind):
+    # Redis has no cheap count of just our keys, so only the local stores report their size
+    if kind != 'redis':
+        Gauge('session_store_sessions', 'Sessions held in the session store', lambda: len(store))
+
+def make_session_store(kind, threshold, archive=None):
+    if kind == 'sqlite':
+        return SQLiteSessionStore(threshold, archive=archive)
+    if kind == 'redis':
+        import redis
+        return RedisSessionStore(threshold, redis.Redis.from_url(redis_url), archive=archive)
+    return MemorySessionStore(threshold, archive=archive)
@@ -0,0 +1,154 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import NamedTuple
+import math
+import os
+import time
+
+import numpy as np
+
+# Sessions are a few KB each now, so a worker can hold far more of them than before
+session_cache_size = int(os.environ.get('SESSION_CACHE_SIZE', 100000))
+
+class Session:
+    # Per-frame results live in flat typed arrays sorted by timestamp rather than a dict of boxed
+    # floats: 16 bytes per frame instead of ~100. Whole-session aggregates are kept up to date as
+    # frames arrive so polling them is O(1).
+    __slots__ = ('user_id', 'baseline_embedding', 'threshold', 'timestamps', 'distances',
+                 'present_count', 'mean', 'm2', 'updated_at')
+
+    def __init__(self, user_id, baseline_embedding, threshold):
+        self.user_id = user_id
+        self.baseline_embedding = np.asarray(baseline_embedding, dtype=np.float32)
+        self.threshold = threshold
+        self.timestamps = array('q')
+        # Kept as doubles so results match the distances computed from the embeddings exactly
+        self.distances = array('d')
+        # Running count of present frames and Welford mean / sum of squared deviations
+        self.present_count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.updated_at = time.time()
+
+    @classmethod
+    def from_frames(cls, user_id, baseline_embedding, threshold, timestamps, distances, updated_at):
+        # Rebuild a session read back from a shared store; frames must be sorted by timestamp
+        session = cls(user_id, baseline_embedding, threshold)
+        session.timestamps = array('q', timestamps)
+        session.distances = array('d', distances)
+        if len(session.distances):
+            values = np.frombuffer(session.distances, dtype=np.float64)
+            session.present_count = int(np.count_nonzero(values <= threshold))
+            session.mean = float(np.mean(values))
+            session.m2 = float(np.var(values) * len(values))
+        session.updated_at = updated_at
+        return session
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def nearest_distance(self, face_embeddings):
+        # Distance of the nearest face in the frame, or 1 if there are none
+        if len(face_embeddings) == 0:
+            return 1
+        distances = np.linalg.norm(np.array([self.baseline_embedding]) - np.array(face_embeddings), axis=1)/2
+        return min(1, distances.min().item())
+
+    def add(self, timestamp, distance):
+        # Frames normally arrive in order; a late frame is inserted in place and a repeated
+        # timestamp replaces the earlier distance
+        self.updated_at = time.time()
+        if len(self.timestamps) == 0 or timestamp > self.timestamps[-1]:
+            self.timestamps.append(timestamp)
+            self.distances.append(distance)
+        else:
+            i = bisect_left(self.timestamps, timestamp)
+            if self.timestamps[i] == timestamp:
+                self.remove_from_aggregates(self.distances[i], len(self.timestamps))
+                self.distances[i] = distance
+            else:
+                self.timestamps.insert(i, timestamp)
+                self.distances.insert(i, distance)
+        self.add_to_aggregates(distance, len(self.timestamps))
+
+    def add_to_aggregates(self, distance, count):
+        # count includes the new distance
+        self.present_count += distance <= self.threshold
+        delta = distance - self.mean
+        self.mean += delta / count
+        self.m2 += delta * (distance - self.mean)
+
+    def remove_from_aggregates(self, distance, count):
+        # count includes the distance being removed
+        self.present_count -= distance <= self.threshold
+        if count == 1:
+            self.mean, self.m2 = 0.0, 0.0
+            return
+        mean = (count * self.mean - distance) / (count - 1)
+        self.m2 -= (distance - mean) * (distance - self.mean)
+        self.mean = mean
+
+    def stats(self):
+        # (pct_present, avg_distance, std_distance) over every frame, in O(1)
+        count = len(self.timestamps)
+        return self.present_count / count, self.mean, math.sqrt(max(self.m2, 0.0) / count)
+
+    def window_stats(self, start=None, end=None):
+        # Stats over frames with start <= timestamp <= end, found by binary search on the sorted
+        # timestamps and aggregated over just that slice; None if no frames fall in the window
+        i = 0 if start is None else bisect_left(self.timestamps, start)
+        j = len(self.timestamps) if end is None else bisect_right(self.timestamps, end)
+        if i >= j:
+            return None
+        distances = np.frombuffer(self.distances, dtype=np.float64)[i:j]
+        return np.count_nonzero(distances <= self.threshold)/len(distances), np.mean(distances), np.std(distances)
+
+class SessionColumns(NamedTuple):
+    # Aggregates of many sessions, one array entry per session, so results for a whole fleet are
+    # computed and filtered in a few vectorized passes
+    session_ids: list
+    user_ids: np.ndarray
+    frame_counts: np.ndarray
+    present_counts: np.ndarray
+    means: np.ndarray
+    m2s: np.ndarray
+    updated_at: np.ndarray
+
+    def stats(self):
+        # (pct_present, avg_distance, std_distance) arrays; NaN for sessions without frames
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (self.present_counts / self.frame_counts, np.where(self.frame_counts > 0, self.means, np.nan),
+                    np.sqrt(np.maximum(self.m2s, 0) / self.frame_counts))
+
+def session_columns(items):
+    # From (session_id, Session) pairs, whose aggregates are already kept up to date
+    sessions = [session for _, session in items]
+    n = len(sessions)
+    return SessionColumns(
+        [session_id for session_id, _ in items],
+        np.fromiter((session.user_id for session in sessions), dtype=np.int64, count=n),
+        np.fromiter((len(session.timestamps) for session in sessions), dtype=np.int64, count=n),
+        np.fromiter((session.present_count for session in sessions), dtype=np.int64, count=n),
+        np.fromiter((session.mean for session in sessions), dtype=np.float64, count=n),
+        np.fromiter((session.m2 for session in sessions), dtype=np.float64, count=n),
+        np.fromiter((session.updated_at for session in sessions), dtype=np.float64, count=n),
+    )
+
+def frame_columns(session_ids, user_ids, updated_at, frame_counts, distances, threshold):
+    # From every session's distances concatenated into one array, frame_counts[i] of them per session
+    frame_counts = np.asarray(frame_counts, dtype=np.int64)
+    distances = np.asarray(distances, dtype=np.float64)
+    n = len(frame_counts)
+    present_counts = np.zeros(n, dtype=np.int64)
+    means = np.zeros(n)
+    m2s = np.zeros(n)
+    nonempty = frame_counts > 0
+    if nonempty.any():
+        # Empty sessions add no elements, so the offsets of the others delimit their frames exactly
+        offsets = (np.cumsum(frame_counts) - frame_counts)[nonempty]
+        present_counts[nonempty] = np.add.reduceat((distances <= threshold).astype(np.int64), offsets)
+        means[nonempty] = np.add.reduceat(distances, offsets) / frame_counts[nonempty]
+        deviations = distances - np.repeat(means, frame_counts)
+        m2s[nonempty] = np.add.reduceat(deviations * deviations, offsets)
+    return SessionColumns(list(session_ids), np.asarray(user_ids, dtype=np.int64), frame_counts, present_counts,
+                          means, m2s, np.asarray(updated_at, dtype=np.float64))
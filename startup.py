@@ -0,0 +1,71 @@
+import asyncio
+import gc
+import os
+import threading
+
+import numpy as np
+
+from inference import locate_and_encode
+from preprocess import face_models, raw_bgr, raw_frame_header, raw_frame_magic
+
+# Import the dlib models when main.py is imported instead of on first use. Meant for a server that
+# imports the app once and forks its workers from it, e.g.
+#   PRELOAD_MODELS=1 gunicorn main:app --preload -w 4 -k uvicorn.workers.UvicornWorker
+# so the model pages are shared copy-on-write between the workers
+preload_models = os.environ.get('PRELOAD_MODELS', '0') == '1'
+# Image run through every detector configuration at startup before /ready reports ready; a blank
+# frame is used when unset, which warms detection but not encoding
+warmup_image = os.environ.get('WARMUP_IMAGE')
+# Rounds of warm-up inference, each one call per inference worker (0 skips warm-up)
+warmup_rounds = int(os.environ.get('WARMUP_ROUNDS', 1))
+
+class Lazy:
+    # Stands in for an object that is slow to build (a database client, an index loaded from it),
+    # building it on first use. Startup builds them ahead of traffic by calling load().
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __len__(self):
+        return len(self.load())
+
+def resolve(value):
+    # The object behind a Lazy (building it if needed), so hot paths can drop the indirection
+    return value.load() if isinstance(value, Lazy) else value
+
+def load_models():
+    face_models()
+    import imageio.v3
+
+def preload():
+    # Runs before the fork, so nothing here may start threads or open database connections
+    load_models()
+    # Keep the collector from touching (and so copying) every preloaded object in each worker
+    gc.collect()
+    gc.freeze()
+
+def warmup_file():
+    if warmup_image is not None:
+        with open(warmup_image, 'rb') as f:
+            return f.read()
+    blank = np.zeros((480, 640, 3), dtype=np.uint8)
+    return raw_frame_header.pack(raw_frame_magic, blank.shape[1], blank.shape[0], raw_bgr) + blank.tobytes()
+
+async def warm_up(executor, configs, workers):
+    # Enough concurrent calls per round to start every worker thread and give each one a first run
+    file = warmup_file()
+    for _ in range(warmup_rounds):
+        for config in set(configs):
+            await asyncio.gather(*(executor.run(locate_and_encode, file, config, block=True)
+                                   for _ in range(workers)))
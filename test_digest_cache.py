@@ -0,0 +1,58 @@
+import numpy as np
+
+from digest_cache import DigestCache, upload_digest
+from preprocess import DetectorConfig
+
+def faces(n):
+    return [(i, i + 10, i + 10, i) for i in range(n)], [np.full(128, i, dtype=np.float64) for i in range(n)]
+
+def test_digest_depends_on_bytes_and_config():
+    assert upload_digest(b"abc", DetectorConfig()) == upload_digest(b"abc", DetectorConfig())
+    assert upload_digest(b"abc", DetectorConfig()) != upload_digest(b"abd", DetectorConfig())
+    assert upload_digest(b"abc", DetectorConfig()) != upload_digest(b"abc", DetectorConfig(num_jitters=2))
+
+def test_memory_tier_evicts_least_recently_used():
+    cache = DigestCache(memory_bytes=3600, disk_bytes=0)
+    for key in "abc":
+        cache.put(key, *faces(1))
+    assert cache.get("a") is not None
+    cache.put("d", *faces(1))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+
+def test_disk_tier_survives_restart(tmp_path):
+    cache = DigestCache(memory_bytes=1 << 20, disk_bytes=1 << 20, directory=str(tmp_path))
+    cache.put("k", *faces(2))
+    restarted = DigestCache(memory_bytes=1 << 20, disk_bytes=1 << 20, directory=str(tmp_path))
+    locations, encodings = restarted.get("k")
+    assert locations == faces(2)[0]
+    assert np.array_equal(encodings[1], faces(2)[1][1])
+    assert "k" in restarted.entries
+
+def test_disk_tier_is_bounded(tmp_path):
+    cache = DigestCache(memory_bytes=0, disk_bytes=20000, directory=str(tmp_path))
+    for i in range(50):
+        cache.put(str(i), *faces(1))
+    assert cache.disk_used <= 20000
+    assert sum(path.stat().st_size for path in tmp_path.iterdir()) <= 20000
+
+def test_unreadable_disk_entry_is_dropped(tmp_path):
+    cache = DigestCache(memory_bytes=1 << 20, disk_bytes=1 << 20, directory=str(tmp_path))
+    cache.put("torn", *faces(1))
+    cache.put("empty", *faces(1))
+    with open(cache.path("torn"), "r+b") as f:
+        f.truncate(20)
+    open(cache.path("empty"), "wb").close()
+    restarted = DigestCache(memory_bytes=1 << 20, disk_bytes=1 << 20, directory=str(tmp_path))
+    assert restarted.get("torn") is None
+    assert restarted.get("empty") is None
+    assert sorted(path.name for path in tmp_path.iterdir()) == []
+
+def test_eviction_skips_files_still_being_written(tmp_path):
+    cache = DigestCache(memory_bytes=0, disk_bytes=20000, directory=str(tmp_path))
+    # Another worker's write in progress
+    (tmp_path / "other.tmp").write_bytes(b"x" * 30000)
+    for i in range(50):
+        cache.put(str(i), *faces(1))
+    assert (tmp_path / "other.tmp").exists()
+    assert cache.disk_used <= 20000
@@ -0,0 +1,65 @@
+import numpy as np
+
+from embedding_store import EmbeddingStore
+
+def make_loader(calls):
+    def loader(user_id):
+        calls.append(user_id)
+        if user_id < 0:
+            return None
+        return np.full(128, user_id, dtype=np.float32)
+    return loader
+
+def test_read_through_caches_embeddings():
+    calls = []
+    store = EmbeddingStore(make_loader(calls), max_users=4)
+    assert store.get(1)[0] == 1
+    assert store.get(1)[0] == 1
+    assert calls == [1]
+    assert store.get(1).dtype == np.float32
+
+def test_missing_user_is_not_cached():
+    calls = []
+    store = EmbeddingStore(make_loader(calls), max_users=4)
+    assert store.get(-1) is None
+    assert -1 not in store
+
+def test_least_recently_used_user_is_evicted():
+    calls = []
+    store = EmbeddingStore(make_loader(calls), max_users=2)
+    store.get(1)
+    store.get(2)
+    store.get(1)
+    store.get(3)
+    assert 2 not in store
+    assert 1 in store and 3 in store
+    assert store.get(3)[0] == 3
+    assert store.get(1)[0] == 1
+
+def test_put_and_delete_update_in_place():
+    calls = []
+    store = EmbeddingStore(make_loader(calls), max_users=2)
+    store.put(5, np.zeros(128))
+    assert store.get(5)[0] == 0
+    store.delete(5)
+    assert store.get(5)[0] == 5
+    assert calls == [5]
+
+def test_matrix_grows_up_to_bound():
+    calls = []
+    store = EmbeddingStore(make_loader(calls), max_users=3000)
+    for user_id in range(2000):
+        store.get(user_id)
+    assert len(store) == 2000
+    assert len(store.matrix) == 2048
+    assert store.get(1500)[0] == 1500
+
+def test_entries_expire_after_ttl():
+    calls = []
+    store = EmbeddingStore(make_loader(calls), max_users=4, ttl=60)
+    store.get(1)
+    store.get(1)
+    assert calls == [1]
+    store.loaded_at[store.rows[1]] -= 120
+    assert store.get(1)[0] == 1
+    assert calls == [1, 1]
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+
+from gallery import QuantizedGallery, dequantize, quantize
+from search import ExactSearch, sync_collection
+
+def make_gallery(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(0, 0.1, size=(n, 128)).astype(np.float32)
+
+@pytest.mark.parametrize("dtype, tolerance", [("float16", 1e-3), ("int8", 5e-3)])
+def test_quantize_round_trip(dtype, tolerance):
+    embeddings = make_gallery(10)
+    vectors, scales = quantize(embeddings, dtype)
+    assert np.abs(dequantize(vectors, scales) - embeddings).max() < tolerance
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_quantized_search_matches_exact(tmp_path, dtype):
+    embeddings = make_gallery(500)
+    ids = [str(i) for i in range(500)]
+    gallery = QuantizedGallery(str(tmp_path), dtype)
+    gallery.add(ids, embeddings)
+    exact = ExactSearch()
+    exact.add(ids, embeddings)
+
+    queries = embeddings[:20] + np.random.default_rng(1).normal(0, 0.01, size=(20, 128)).astype(np.float32)
+    found, distances = gallery.search(queries, 1)
+    expected, expected_distances = exact.search(queries, 1)
+    assert found == expected
+    assert np.abs(np.array(distances) - expected_distances).max() < 0.01
+
+def test_tombstones_and_updates(tmp_path):
+    embeddings = make_gallery(3)
+    gallery = QuantizedGallery(str(tmp_path))
+    gallery.add(["1", "2", "3"], embeddings)
+    gallery.remove(["2"])
+    gallery.add(["3"], embeddings[:1])
+
+    assert len(gallery) == 2
+    assert gallery.get(2) is None
+    assert np.abs(gallery.get(3) - embeddings[0]).max() < 5e-3
+    ids, _ = gallery.search(embeddings, 3)
+    assert all("2" not in query_ids for query_ids in ids)
+    assert gallery.search(embeddings[1:2], 1)[0] != [["2"]]
+
+def test_reopen_maps_existing_rows(tmp_path):
+    embeddings = make_gallery(2000)
+    gallery = QuantizedGallery(str(tmp_path))
+    gallery.add([str(i) for i in range(2000)], embeddings)
+    gallery.remove(["7"])
+    gallery.flush()
+
+    reopened = QuantizedGallery(str(tmp_path))
+    assert len(reopened) == 1999
+    assert reopened.get(7) is None
+    assert np.abs(reopened.get(1999) - embeddings[1999]).max() < 5e-3
+    with pytest.raises(ValueError):
+        QuantizedGallery(str(tmp_path), "float16")
+
+def test_compaction_drops_tombstones(tmp_path):
+    embeddings = make_gallery(2000)
+    gallery = QuantizedGallery(str(tmp_path), compact_ratio=2)
+    gallery.add([str(i) for i in range(2000)], embeddings)
+    gallery.remove([str(i) for i in range(0, 2000, 2)])
+    gallery.compact()
+
+    assert gallery.generation == 1
+    assert gallery.count == len(gallery) == 1000
+    assert gallery.get(0) is None
+    assert np.abs(gallery.get(1) - embeddings[1]).max() < 5e-3
+    assert gallery.search(embeddings[1:2], 1)[0] == [["1"]]
+
+    reopened = QuantizedGallery(str(tmp_path))
+    assert reopened.generation == 1
+    assert len(reopened) == 1000
+
+def test_processes_sharing_a_gallery_see_each_others_writes(tmp_path):
+    # Two instances on one directory stand in for two worker processes
+    embeddings = make_gallery(3)
+    first = QuantizedGallery(str(tmp_path))
+    second = QuantizedGallery(str(tmp_path))
+    first.add(["1"], embeddings[:1])
+    second.add(["2"], embeddings[1:2])
+    assert np.abs(first.get(1) - embeddings[0]).max() < 5e-3
+    assert np.abs(first.get(2) - embeddings[1]).max() < 5e-3
+    assert first.search(embeddings[1:2], 1)[0] == [["2"]]
+    second.remove(["1"])
+    assert first.get(1) is None
+    assert len(first) == len(second) == 1
+
+    reopened = QuantizedGallery(str(tmp_path))
+    assert reopened.live_ids() == {"2"}
+
+def test_compaction_is_seen_by_other_processes(tmp_path):
+    embeddings = make_gallery(2000)
+    first = QuantizedGallery(str(tmp_path), compact_ratio=2)
+    second = QuantizedGallery(str(tmp_path), compact_ratio=2)
+    first.add([str(i) for i in range(2000)], embeddings)
+    second.remove([str(i) for i in range(0, 2000, 2)])
+    second.compact()
+    assert first.search(embeddings[1:2], 1)[0] == [["1"]]
+    assert first.generation == 1
+    first.add(["0"], embeddings[:1])
+    assert np.abs(second.get(0) - embeddings[0]).max() < 5e-3
+
+class FakeCollection:
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def get(self, ids=None, include=(), limit=None, offset=0):
+        if ids is None:
+            ids = list(self.embeddings)[offset:offset + limit]
+        return {"ids": ids, "embeddings": [self.embeddings[user_id] for user_id in ids]}
+
+def test_sync_collection_fills_missing_and_drops_deleted(tmp_path):
+    embeddings = make_gallery(3)
+    gallery = QuantizedGallery(str(tmp_path))
+    gallery.add(["1", "9"], embeddings[:2])
+    sync_collection(gallery, FakeCollection({"1": embeddings[0], "2": embeddings[2]}), page_size=1)
+    assert gallery.live_ids() == {"1", "2"}
+    assert np.abs(gallery.get(2) - embeddings[2]).max() < 5e-3
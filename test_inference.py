@@ -0,0 +1,85 @@
+import asyncio
+import threading
+
+import pytest
+
+from inference import InferenceExecutor, InferenceQueueFull, MicroBatcher
+from metrics import render_metrics
+
+def test_micro_batcher_fans_out_results():
+    async def run():
+        executor = InferenceExecutor('thread', 1, 4)
+        batcher = MicroBatcher(executor, lambda items: [(item, len(items)) for item in items], 8, 50)
+        return await asyncio.gather(*(batcher.submit(i) for i in range(3)))
+
+    assert asyncio.run(run()) == [(0, 3), (1, 3), (2, 3)]
+    assert "inference_batch_size_count" in render_metrics()
+
+def test_micro_batcher_flushes_at_max_batch_size():
+    async def run():
+        executor = InferenceExecutor('thread', 1, 4)
+        batcher = MicroBatcher(executor, lambda items: [len(items)] * len(items), 2, 1000)
+        return await asyncio.gather(*(batcher.submit(i) for i in range(4)))
+
+    assert asyncio.run(run()) == [2, 2, 2, 2]
+
+def test_executor_rejects_when_queue_full():
+    async def run():
+        executor = InferenceExecutor('thread', 1, 0)
+        executor.pending = executor.max_pending
+        await executor.run(len, [])
+
+    with pytest.raises(InferenceQueueFull):
+        asyncio.run(run())
+
+def test_micro_batcher_fails_only_the_bad_item():
+    def fn(items):
+        return [ValueError(item) if item == 'bad' else item for item in items]
+
+    async def run():
+        executor = InferenceExecutor('thread', 1, 4)
+        batcher = MicroBatcher(executor, fn, 8, 50)
+        return await asyncio.gather(*(batcher.submit(item) for item in ['good', 'bad']), return_exceptions=True)
+
+    good, bad = asyncio.run(run())
+    assert good == 'good'
+    assert isinstance(bad, ValueError)
+
+def test_unbatched_items_run_on_their_own():
+    async def run():
+        executor = InferenceExecutor('thread', 2, 4)
+        batcher = MicroBatcher(executor, lambda items: [len(items)] * len(items), 8, 1000, batched=False)
+        return await asyncio.gather(*(batcher.submit(i) for i in range(3)))
+
+    assert asyncio.run(run()) == [1, 1, 1]
+
+def test_executor_counts_each_frame_of_a_batch():
+    async def run():
+        executor = InferenceExecutor('thread', 1, 3)
+        executor.pending = 1
+        # Three more frames fit within the bound of four, four more don't
+        assert await executor.run(len, [1, 2, 3], cost=3) == 3
+        await executor.run(len, [1, 2, 3, 4], cost=4)
+
+    with pytest.raises(InferenceQueueFull):
+        asyncio.run(run())
+
+def test_freed_slot_wakes_every_waiter_that_fits():
+    async def run():
+        executor = InferenceExecutor('thread', 2, 0)
+        first, second = threading.Event(), threading.Event()
+        holders = [asyncio.ensure_future(executor.run(event.wait)) for event in (first, second)]
+        await asyncio.sleep(0.01)
+        # Queued behind the holders: one that needs both slots, then one that needs a single slot
+        large = asyncio.ensure_future(executor.run(len, [1, 2], block=True, cost=2))
+        await asyncio.sleep(0.01)
+        small = asyncio.ensure_future(executor.run(len, [1], block=True))
+        await asyncio.sleep(0.01)
+        first.set()
+        # Only one slot is free, which the large call can't use but the small one can
+        result = await asyncio.wait_for(small, 1)
+        second.set()
+        await asyncio.gather(large, *holders)
+        return result
+
+    assert asyncio.run(run()) == 1
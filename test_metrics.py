@@ -0,0 +1,27 @@
+import metrics
+from metrics import HistogramFamily, render_metrics, stage_timer
+
+def test_histogram_family_renders_one_series_per_label():
+    family = HistogramFamily('test_family_seconds', 'Test family', 'stage', [0.1, 1])
+    family.labels('decode').observe(0.05)
+    family.labels('decode').observe(0.5)
+    family.labels('encode').observe(2)
+
+    rendered = render_metrics()
+    assert rendered.count('# TYPE test_family_seconds histogram') == 1
+    assert 'test_family_seconds_bucket{stage="decode",le="0.1"} 1' in rendered
+    assert 'test_family_seconds_bucket{stage="decode",le="+Inf"} 2' in rendered
+    assert 'test_family_seconds_count{stage="encode"} 1' in rendered
+
+def test_stage_timer_records_into_family():
+    family = HistogramFamily('test_timer_seconds', 'Test timer', 'stage', [1])
+    with stage_timer('work', family):
+        pass
+    assert family.labels('work').count == 1
+
+def test_stage_timer_is_a_no_op_when_disabled(monkeypatch):
+    monkeypatch.setattr(metrics, 'metrics_enabled', False)
+    family = HistogramFamily('test_disabled_seconds', 'Test disabled', 'stage', [1])
+    with stage_timer('work', family):
+        pass
+    assert family.children == {}
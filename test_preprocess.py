@@ -0,0 +1,76 @@
+import struct
+
+import numpy as np
+import pytest
+
+from preprocess import (DetectorConfig, RawUploadError, bounding_box, decode, expand_box, frame_hash,
+                        hash_distance, parse_detector_config, raw_embeddings)
+
+def test_default_config_is_original_path():
+    assert parse_detector_config("") == DetectorConfig(model="hog", num_jitters=1, upsample=1, decode_scale=1,
+                                                       detector_width=0, roi_margin=0.0)
+
+def test_parse_detector_config():
+    config = parse_detector_config("model=cnn, num_jitters=3,decode_scale=2,roi_margin=0.5")
+    assert config.model == "cnn"
+    assert config.num_jitters == 3
+    assert config.decode_scale == 2
+    assert config.roi_margin == 0.5
+
+def test_parse_detector_config_rejects_bad_values():
+    with pytest.raises(ValueError):
+        parse_detector_config("model=mtcnn")
+    with pytest.raises(ValueError):
+        parse_detector_config("decode_scale=3")
+
+def test_expand_box_is_clamped_to_image():
+    assert expand_box((10, 60, 60, 10), 0.5, (100, 80, 3)) == (0, 80, 85, 0)
+    assert expand_box((40, 50, 50, 40), 0.5, (100, 100, 3)) == (35, 55, 55, 35)
+
+def test_bounding_box():
+    assert bounding_box([]) is None
+    assert bounding_box([(10, 50, 40, 20), (5, 30, 60, 25)]) == (5, 50, 60, 20)
+
+def test_frame_hash_ignores_small_changes():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 255, size=(120, 160, 3), dtype=np.uint8)
+    noisy = np.clip(image.astype(int) + rng.integers(-2, 3, size=image.shape), 0, 255).astype(np.uint8)
+    assert hash_distance(frame_hash(image), frame_hash(image)) == 0
+    assert hash_distance(frame_hash(image), frame_hash(noisy)) <= 4
+    assert hash_distance(frame_hash(image), frame_hash(255 - image)) > 32
+
+def raw_frame_bytes(pixels, pixel_format):
+    height, width = pixels.shape[:2]
+    return struct.pack("<4sIIB3x", b"RAWF", width, height, pixel_format) + pixels.tobytes()
+
+def test_raw_bgr_frame_is_not_copied():
+    image = np.random.default_rng(0).integers(0, 255, size=(6, 4, 3), dtype=np.uint8)
+    frame = decode(raw_frame_bytes(image, 1), DetectorConfig())
+    assert np.array_equal(frame, image)
+    assert not frame.flags.owndata
+
+def test_raw_rgb_and_gray_frames_are_converted_to_bgr():
+    image = np.random.default_rng(0).integers(0, 255, size=(6, 4, 3), dtype=np.uint8)
+    assert np.array_equal(decode(raw_frame_bytes(image[:, :, ::-1].copy(), 2), DetectorConfig()), image)
+    gray = image[:, :, 0].copy()
+    assert np.array_equal(decode(raw_frame_bytes(gray, 0), DetectorConfig()), np.dstack([gray] * 3))
+
+def test_raw_frame_rejects_bad_payloads():
+    image = np.zeros((6, 4, 3), dtype=np.uint8)
+    with pytest.raises(RawUploadError):
+        decode(raw_frame_bytes(image, 1)[:-1], DetectorConfig())
+    with pytest.raises(RawUploadError):
+        decode(raw_frame_bytes(image, 7), DetectorConfig())
+    with pytest.raises(RawUploadError):
+        decode(b"RAWF", DetectorConfig())
+
+def test_raw_embeddings():
+    embeddings = np.random.default_rng(0).standard_normal((2, 128)).astype(np.float32)
+    raw = struct.pack("<4sI8x", b"RAWE", 2) + embeddings.tobytes()
+    assert np.array_equal(raw_embeddings(raw), embeddings)
+    with pytest.raises(RawUploadError):
+        raw_embeddings(raw[:-4])
+    empty = struct.pack("<4sI8x", b"RAWE", 0)
+    with pytest.raises(RawUploadError):
+        raw_embeddings(empty)
+    assert raw_embeddings(empty, min_count=0).shape == (0, 128)
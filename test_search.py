@@ -0,0 +1,120 @@
+import os
+
+import numpy as np
+
+from search import ExactSearch, IVFSearch, SearchJournal, SyncedSearch, load_collection
+
+def make_gallery(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(0, 0.1, size=(n, 128)).astype(np.float32)
+
+def brute_force(gallery, query, k):
+    distances = np.linalg.norm(gallery - query, axis=1) / 2
+    return list(np.argsort(distances)[:k])
+
+def test_exact_search_matches_brute_force():
+    gallery = make_gallery(500)
+    index = ExactSearch()
+    index.add([str(i) for i in range(len(gallery))], gallery)
+    ids, distances = index.search(gallery[:3], 5)
+    for i in range(3):
+        assert ids[i] == [str(row) for row in brute_force(gallery, gallery[i], 5)]
+        assert distances[i][0] == 0
+
+def test_exact_search_remove_and_update():
+    gallery = make_gallery(10)
+    index = ExactSearch(capacity=4)
+    index.add([str(i) for i in range(len(gallery))], gallery)
+    index.remove(["0", "3"])
+    assert len(index) == 8
+    ids, _ = index.search(gallery[9:10], 1)
+    assert ids == [["9"]]
+    index.add(["9"], gallery[1:2])
+    ids, _ = index.search(gallery[1:2], 2)
+    assert sorted(ids[0]) == ["1", "9"]
+
+def test_exact_search_memory_mapped(tmp_path):
+    gallery = make_gallery(3000)
+    index = ExactSearch(str(tmp_path))
+    index.add([str(i) for i in range(len(gallery))], gallery)
+    ids, distances = index.search(gallery[2500:2501], 1)
+    assert ids == [["2500"]]
+    assert distances[0][0] == 0
+    # Each process maps its own unlinked file, so another index can't resize or overwrite it
+    other = ExactSearch(str(tmp_path))
+    other.add(["x"], gallery[:1])
+    assert index.search(gallery[2999:3000], 1)[0] == [["2999"]]
+    assert list(tmp_path.iterdir()) == []
+
+def test_ivf_search_probing_every_list_is_exact():
+    gallery = make_gallery(2000)
+    index = IVFSearch(n_probe=10000, min_train_size=100)
+    index.add([str(i) for i in range(len(gallery))], gallery)
+    index.remove(["5"])
+    ids, distances = index.search(gallery[:2], 3)
+    assert ids[0][0] == "0"
+    assert ids[1][0] == "1"
+    assert "5" not in ids[0]
+    assert distances[0][0] == 0
+
+def test_ivf_search_adds_to_existing_lists_and_retrains_in_background():
+    gallery = make_gallery(400)
+    index = IVFSearch(n_probe=10000, min_train_size=100)
+    index.add([str(i) for i in range(100)], gallery[:100])
+    index.search(gallery[:1], 1)
+    centroids = index.centroids
+    index.add(["100"], gallery[100:101])
+    # Found through its nearest list without retraining
+    assert index.centroids is centroids
+    assert index.search(gallery[100:101], 1)[0] == [["100"]]
+    # Doubling the gallery retrains off the calling thread
+    index.add([str(i) for i in range(101, 400)], gallery[101:])
+    if index.training is not None:
+        index.training.join()
+    assert len(index.centroids) == 20
+    assert index.search(gallery[399:400], 1)[0] == [["399"]]
+
+class FakeCollection:
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def get(self, ids=None, include=(), limit=None, offset=0):
+        if ids is None:
+            ids = sorted(self.embeddings)[offset:offset + limit if limit else None]
+        found = [user_id for user_id in ids if user_id in self.embeddings]
+        return {"ids": found, "embeddings": [self.embeddings[user_id] for user_id in found]}
+
+def test_synced_search_follows_other_workers(tmp_path):
+    gallery = make_gallery(3)
+    collection = FakeCollection({"0": gallery[0]})
+    path = str(tmp_path / "journal.log")
+    first = SyncedSearch(ExactSearch, SearchJournal(path), collection)
+    second = SyncedSearch(ExactSearch, SearchJournal(path), collection)
+    first.add(["0"], gallery[:1])
+    collection.embeddings["1"] = gallery[1]
+    first.add(["1"], gallery[1:2])
+    assert second.search(gallery[1:2], 1)[0] == [["1"]]
+    assert len(second) == 2
+    del collection.embeddings["1"]
+    first.remove(["1"])
+    assert second.search(gallery[1:2], 1)[0] == [["0"]]
+
+def test_synced_search_reloads_once_the_journal_is_replaced(tmp_path):
+    gallery = make_gallery(3)
+    collection = FakeCollection({"0": gallery[0]})
+    path = str(tmp_path / "journal.log")
+
+    def load():
+        index = ExactSearch()
+        load_collection(index, collection)
+        return index
+
+    first = SyncedSearch(load, SearchJournal(path, max_bytes=1), collection)
+    second = SyncedSearch(load, SearchJournal(path, max_bytes=1), collection)
+    collection.embeddings["1"] = gallery[1]
+    first.add(["1"], gallery[1:2])
+    assert os.path.getsize(path) == 0
+    # The entry was dropped with the old journal, so the other worker reloads from the database
+    assert second.search(gallery[1:2], 1)[0] == [["1"]]
+    assert first.search(gallery[1:2], 1)[0] == [["1"]]
+    assert len(second) == 2
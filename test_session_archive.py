@@ -0,0 +1,64 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from session_archive import SessionArchive, read_segment
+from sessions import Session
+
+def make_session(user_id, distances):
+    session = Session(user_id, np.zeros(128), 0.3)
+    for timestamp, distance in enumerate(distances):
+        session.add(timestamp, distance)
+    return session
+
+def test_rescore_matches_sessions(tmp_path):
+    archive = SessionArchive(str(tmp_path), batch_size=4)
+    sessions = {"a": make_session(1, [0.1, 0.5, 0.2]), "b": make_session(2, [0.4, 0.35]),
+                "c": make_session(3, [0.6])}
+    for session_id, session in sessions.items():
+        archive.add(session_id, session)
+        archive.write_due()
+    # Sessions without frames are not archived
+    archive.add("empty", make_session(4, []))
+    # The first two sessions filled a batch, the last is still buffered until read
+    assert len(read_segment(archive.directory).session_ids) == 2
+
+    columns = archive.rescore(0.45)
+    assert columns.session_ids == ["a", "b", "c"]
+    assert list(columns.user_ids) == [1, 2, 3]
+    pct_present, avg_distance, std_distance = columns.stats()
+    for i, session in enumerate(sessions.values()):
+        distances = np.array(session.distances)
+        assert pct_present[i] == np.count_nonzero(distances <= 0.45) / len(distances)
+        assert avg_distance[i] == pytest.approx(np.mean(distances))
+        assert std_distance[i] == pytest.approx(np.std(distances))
+
+    columns = archive.rescore(0.45, ["c", "missing"])
+    assert columns.session_ids == ["c"]
+    assert list(columns.frame_counts) == [1]
+
+def test_segments_from_several_processes(tmp_path):
+    first = SessionArchive(str(tmp_path), batch_size=1)
+    first.add("a", make_session(1, [0.1]))
+    first.write_due()
+    second = SessionArchive(str(tmp_path), batch_size=1)
+    second.add("b", make_session(2, [0.2, 0.3]))
+    second.write_due()
+    assert first.directory != second.directory
+    assert second.rescore(0.3).session_ids == ["a", "b"]
+
+def test_torn_batch_is_ignored(tmp_path):
+    archive = SessionArchive(str(tmp_path), batch_size=1)
+    archive.add("a", make_session(1, [0.1, 0.2]))
+    archive.write_due()
+    # A crash after the frames of the next batch were written but before its session ids
+    with open(os.path.join(archive.directory, "distances.f8"), "ab") as f:
+        f.write(np.array([0.3]).tobytes())
+    with open(os.path.join(archive.directory, "session_ids.jsonl"), "a") as f:
+        f.write(json.dumps("b"))
+    segment = read_segment(archive.directory)
+    assert segment.session_ids == ["a"]
+    assert list(segment.distances) == [0.1, 0.2]
+    assert list(segment.timestamps) == [0, 1]
@@ -0,0 +1,191 @@
+from fnmatch import fnmatchcase
+import time
+
+import numpy as np
+import pytest
+
+from session_archive import SessionArchive
+from session_store import MemorySessionStore, RedisSessionStore, SQLiteSessionStore
+
+class FakeRedis:
+    # Just enough of the redis-py client for RedisSessionStore, kept in a dict
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value if isinstance(value, bytes) else str(value).encode()
+        return True
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hvals(self, key):
+        return list(self.data.get(key, {}).values())
+
+    def scan_iter(self, match):
+        return [key.encode() for key in list(self.data) if fnmatchcase(key, match)]
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field.encode()] = value.encode()
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+@pytest.fixture(params=["memory", "sqlite", "redis", "sqlite-batched"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemorySessionStore(0.3)
+    if request.param == "redis":
+        return RedisSessionStore(0.3, FakeRedis())
+    batch_size = 3 if request.param == "sqlite-batched" else 1
+    return SQLiteSessionStore(0.3, path=str(tmp_path / "sessions.sqlite3"), batch_size=batch_size)
+
+def test_create_append_get(store):
+    baseline = np.arange(128, dtype=np.float32)
+    assert store.get("s1") is None
+    session = store.create("s1", 7, baseline)
+    assert session.user_id == 7
+    assert np.array_equal(session.baseline_embedding, baseline)
+    store.append("s1", 2, 0.2)
+    store.append("s1", 1, 0.5)
+    store.append("s1", 2, 0.1)
+    session = store.get("s1")
+    assert list(session.timestamps) == [1, 2]
+    assert list(session.distances) == [0.5, 0.1]
+    pct_present, avg_distance, _ = session.stats()
+    assert pct_present == 0.5
+    assert avg_distance == pytest.approx(0.3)
+
+def test_create_is_first_writer_wins(store):
+    store.create("s1", 7, np.zeros(128))
+    if isinstance(store, MemorySessionStore):
+        pytest.skip("the in-process store has no concurrent creators")
+    assert store.create("s1", 8, np.zeros(128)).user_id == 7
+
+def test_delete(store):
+    store.create("s1", 7, np.zeros(128))
+    store.append("s1", 1, 0.1)
+    assert store.delete("s1")
+    assert store.get("s1") is None
+    assert not store.delete("s1")
+
+def test_session_lookup_keeps_write_batch(tmp_path):
+    store = SQLiteSessionStore(0.3, path=str(tmp_path / "sessions.sqlite3"), batch_size=3)
+    store.create("s1", 7, np.zeros(128))
+    store.append("s1", 1, 0.1)
+    assert store.get("s1", frames=False).user_id == 7
+    assert len(store.pending) == 1
+    assert list(store.get("s1").distances) == [0.1]
+    assert store.pending == []
+
+def test_late_frames_of_deleted_session_are_dropped(store):
+    store.create("s1", 7, np.zeros(128))
+    store.delete("s1")
+    # A frame scored before the delete, written after it
+    store.append("s1", 1, 0.1)
+    store.flush()
+    assert len(store.create("s1", 8, np.zeros(128))) == 0
+    assert len(store.get("s1")) == 0
+
+def test_columns(store):
+    store.create("s1", 7, np.zeros(128))
+    store.append("s1", 1, 0.1)
+    store.append("s1", 2, 0.5)
+    store.append("s1", 3, 0.2)
+    store.create("s2", 8, np.zeros(128))
+    columns = store.columns()
+    order = np.argsort(columns.session_ids)
+    assert [columns.session_ids[i] for i in order] == ["s1", "s2"]
+    assert list(columns.user_ids[order]) == [7, 8]
+    assert list(columns.frame_counts[order]) == [3, 0]
+    pct_present, avg_distance, std_distance = (values[order] for values in columns.stats())
+    assert pct_present[0] == pytest.approx(2 / 3)
+    assert avg_distance[0] == pytest.approx(np.mean([0.1, 0.5, 0.2]))
+    assert std_distance[0] == pytest.approx(np.std([0.1, 0.5, 0.2]))
+    assert np.isnan(avg_distance[1])
+    assert columns.updated_at[order][0] > 0
+    columns = store.columns(["s2", "missing"])
+    assert columns.session_ids == ["s2"]
+
+def test_sqlite_columns_keep_precision_for_close_distances(tmp_path):
+    store = SQLiteSessionStore(0.3, path=str(tmp_path / "sessions.sqlite3"), batch_size=500)
+    session = store.create("s1", 7, np.zeros(128))
+    distances = 0.3 + 1e-8 * np.random.default_rng(0).standard_normal(2000)
+    for timestamp, distance in enumerate(distances.tolist()):
+        store.append("s1", timestamp, distance)
+        session.add(timestamp, distance)
+    columns = store.columns(["s1"])
+    # Matches the in-memory Welford aggregate, where sum(x^2) - sum * mean would be mostly rounding error
+    assert columns.m2s[0] == pytest.approx(session.m2, rel=1e-6, abs=0)
+    assert columns.m2s[0] == pytest.approx(np.var(distances) * len(distances), rel=1e-6, abs=0)
+
+def test_deleted_sessions_are_archived(store, tmp_path):
+    store.archive = SessionArchive(str(tmp_path / "archive"))
+    store.create("s1", 7, np.zeros(128))
+    store.append("s1", 1, 0.1)
+    store.append("s1", 2, 0.5)
+    assert store.delete("s1")
+    assert not store.delete("s1")
+    columns = store.archive.rescore(0.6)
+    assert columns.session_ids == ["s1"]
+    assert list(columns.user_ids) == [7]
+    assert columns.stats()[0][0] == 1.0
+
+def test_evicted_sessions_are_archived(tmp_path):
+    store = MemorySessionStore(0.3, size=1, archive=SessionArchive(str(tmp_path)))
+    store.create("s1", 7, np.zeros(128))
+    store.append("s1", 1, 0.1)
+    store.create("s2", 8, np.zeros(128))
+    assert store.archive.rescore(0.3).session_ids == ["s1"]
+
+def test_idle_and_live_sessions_are_archived(tmp_path):
+    store = MemorySessionStore(0.3, ttl=60, archive=SessionArchive(str(tmp_path)))
+    for session_id in ("idle", "live"):
+        store.create(session_id, 7, np.zeros(128))
+        store.append(session_id, 1, 0.1)
+    store.get("idle").updated_at = time.time() - 120
+    store.purge_expired()
+    assert store.get("idle") is None
+    assert store.archive.rescore(0.3).session_ids == ["idle"]
+    store.close()
+    assert store.archive.rescore(0.3).session_ids == ["idle", "live"]
+    # Closing again (e.g. the lifespan re-entered) doesn't archive the same sessions twice
+    store.close()
+    assert store.archive.rescore(0.3).session_ids == ["idle", "live"]
+
+def test_sessions_expire_after_ttl():
+    store = MemorySessionStore(0.3, ttl=60)
+    store.create("s1", 7, np.zeros(128))
+    store.get("s1").updated_at = time.time() - 120
+    assert store.get("s1") is None
+
+def test_sqlite_store_is_shared_between_connections(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    first = SQLiteSessionStore(0.3, path=path)
+    second = SQLiteSessionStore(0.3, path=path)
+    first.create("s1", 7, np.zeros(128))
+    first.append("s1", 1, 0.1)
+    second.append("s1", 2, 0.4)
+    assert list(first.get("s1").distances) == [0.1, 0.4]
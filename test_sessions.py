@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from sessions import Session, frame_columns, session_columns
+
+def make_session(distances=()):
+    session = Session(1, np.zeros(128), 0.3)
+    for timestamp, distance in enumerate(distances):
+        session.add(timestamp, distance)
+    return session
+
+def test_add_keeps_frames_sorted_by_timestamp():
+    session = make_session()
+    session.add(10, 0.1)
+    session.add(30, 0.3)
+    session.add(20, 0.2)
+    assert list(session.timestamps) == [10, 20, 30]
+    assert list(session.distances) == [0.1, 0.2, 0.3]
+
+def test_repeated_timestamp_replaces_distance():
+    session = make_session()
+    session.add(10, 0.1)
+    session.add(20, 0.2)
+    session.add(10, 0.5)
+    assert len(session) == 2
+    assert list(session.distances) == [0.5, 0.2]
+    pct_present, avg_distance, std_distance = session.stats()
+    assert pct_present == 0.5
+    assert avg_distance == pytest.approx(np.mean([0.5, 0.2]))
+    assert std_distance == pytest.approx(np.std([0.5, 0.2]))
+
+def test_running_stats_match_full_recompute():
+    rng = np.random.default_rng(0)
+    distances = rng.uniform(0, 0.6, size=500)
+    session = make_session(distances)
+    # Late and duplicate frames
+    session.add(-5, 0.05)
+    session.add(250, 0.55)
+    expected = np.append(np.delete(distances, 250), [0.05, 0.55])
+    pct_present, avg_distance, std_distance = session.stats()
+    assert pct_present == np.count_nonzero(expected <= 0.3) / len(expected)
+    assert avg_distance == pytest.approx(np.mean(expected))
+    assert std_distance == pytest.approx(np.std(expected))
+
+def test_window_stats():
+    session = make_session([0.1, 0.2, 0.5, 0.6])
+    pct_present, avg_distance, std_distance = session.window_stats(start=2)
+    assert pct_present == 0
+    assert avg_distance == np.mean([0.5, 0.6])
+    assert std_distance == np.std([0.5, 0.6])
+    assert session.window_stats(start=1, end=2)[1] == np.mean([0.2, 0.5])
+    assert session.window_stats(start=10) is None
+
+def test_nearest_distance():
+    session = make_session()
+    assert session.nearest_distance([]) == 1
+    faces = [np.full(128, 0.1), np.full(128, 0.01)]
+    assert session.nearest_distance(faces) == pytest.approx(np.linalg.norm(np.full(128, 0.01))/2)
+    assert session.baseline_embedding.dtype == np.float32
+
+def test_frame_columns_match_session_stats():
+    sessions = [make_session([0.1, 0.5, 0.2]), make_session(), make_session([0.4])]
+    distances = np.concatenate([np.frombuffer(session.distances) for session in sessions])
+    columns = frame_columns(["a", "b", "c"], [1, 1, 1], [0, 0, 0], [len(session) for session in sessions],
+                            distances, 0.3)
+    expected = session_columns(list(zip(["a", "b", "c"], sessions)))
+    for values, expected_values in zip(columns.stats(), expected.stats()):
+        assert np.allclose(values, expected_values, equal_nan=True)
+    assert list(columns.present_counts) == [2, 0, 0]
@@ -0,0 +1,19 @@
+from startup import Lazy, resolve
+
+def test_lazy_builds_once_on_first_use():
+    built = []
+
+    def build():
+        built.append(1)
+        return [1, 2, 3]
+
+    value = Lazy(build)
+    assert built == []
+    assert len(value) == 3
+    assert value.index(2) == 1
+    assert built == [1]
+
+def test_resolve_unwraps_lazy_values():
+    target = {"a": 1}
+    assert resolve(Lazy(lambda: target)) is target
+    assert resolve(target) is target
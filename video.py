@@ -0,0 +1,96 @@
+from collections import deque
+from statistics import NormalDist
+import asyncio
+import io
+import math
+import os
+
+from inference import frame_distance
+
+# By default every 10th frame of an uploaded video is scored
+video_frame_stride = int(os.environ.get('VIDEO_FRAME_STRIDE', 10))
+# Early exit never stops before this many frames have been scored
+video_min_frames = int(os.environ.get('VIDEO_MIN_FRAMES', 10))
+
+def video_fps(source):
+    # Imported on first use to keep it off the startup path
+    import imageio.v3 as iio
+    return iio.immeta(source, extension=".mp4").get('fps')
+
+def sample_frames(source, stride=video_frame_stride, fps=None, keyframes=False):
+    # Yield (frame_index, timestamp_seconds, frame) for the sampled frames only, decoding one
+    # frame at a time so memory doesn't grow with the length of the video
+    import imageio.v3 as iio
+    source_fps = video_fps(source) or 0
+    if keyframes:
+        yield from sample_keyframes(source, source_fps)
+        return
+    if fps and source_fps:
+        stride = max(1, round(source_fps / fps))
+    for index, frame in enumerate(iio.imiter(source, extension=".mp4")):
+        # Matches the original 1-based frame_count % stride == 0 sampling
+        if (index + 1) % stride == 0:
+            yield index, index / source_fps if source_fps else None, frame
+
+def sample_keyframes(source, source_fps):
+    # imageio can't skip non-key frames at the codec level, so drop down to PyAV for this mode
+    import av
+    with av.open(io.BytesIO(source) if isinstance(source, bytes) else source) as container:
+        stream = container.streams.video[0]
+        stream.codec_context.skip_frame = 'NONKEY'
+        for frame in container.decode(stream):
+            timestamp = float(frame.time) if frame.time is not None else None
+            index = round(timestamp * source_fps) if timestamp is not None and source_fps else None
+            yield index, timestamp, frame.to_ndarray(format='rgb24')
+
+def presence_interval_half_width(present, count, confidence):
+    # Half-width of the Wilson score interval for the fraction of frames with the user present
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = present / count
+    return z * math.sqrt(p * (1 - p) / count + z * z / (4 * count * count)) / (1 + z * z / count)
+
+async def score_frames(executor, frames, baseline_embedding, threshold, window, config,
+                       max_ci_width=None, confidence=0.95, block=False, on_result=None):
+    # Fan sampled frames out to the inference pool, keeping at most `window` in flight, and
+    # return (frame_index, timestamp, distance, faces_found) in frame order. frames is a plain
+    # iterator such as sample_frames; each step decodes video, so it is advanced in a worker
+    # thread. With max_ci_width set, stop as soon as pct_present is known to within that margin.
+    # on_result is called with each of those tuples as soon as it is known.
+    timeline = []
+    in_flight = deque()
+    present = 0
+    early_exit = False
+
+    def collect(result, frame_index, timestamp):
+        nonlocal present
+        distance, faces_found = result
+        present += distance <= threshold
+        timeline.append((frame_index, timestamp, distance, faces_found))
+        if on_result is not None:
+            on_result(*timeline[-1])
+        return (max_ci_width is not None and len(timeline) >= video_min_frames
+                and presence_interval_half_width(present, len(timeline), confidence) <= max_ci_width)
+
+    frames = iter(frames)
+    try:
+        while True:
+            sampled = await asyncio.to_thread(next, frames, None)
+            if sampled is None:
+                break
+            frame_index, timestamp, frame = sampled
+            # Only the first frame can be rejected with a 503; later frames wait for a worker
+            task = asyncio.ensure_future(executor.run(frame_distance, frame, baseline_embedding, config,
+                                                      block=block or bool(timeline or in_flight)))
+            in_flight.append((task, frame_index, timestamp))
+            if len(in_flight) >= window:
+                task, frame_index, timestamp = in_flight.popleft()
+                if collect(await task, frame_index, timestamp):
+                    early_exit = True
+                    break
+        while in_flight and not early_exit:
+            task, frame_index, timestamp = in_flight.popleft()
+            early_exit = collect(await task, frame_index, timestamp)
+    finally:
+        for task, _, _ in in_flight:
+            task.cancel()
+    return timeline, early_exit
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import uuid
+
+from lru import LRU
+
+from sessions import Session
+from video import sample_frames, score_frames
+
+# Videos scored at the same time; further jobs wait their turn
+video_jobs_max_running = int(os.environ.get('VIDEO_JOBS_MAX_RUNNING', 2))
+# Jobs allowed to be queued or running before new ones are rejected
+video_jobs_max_pending = int(os.environ.get('VIDEO_JOBS_MAX_PENDING', 16))
+# Finished jobs kept around for polling
+video_jobs_history = int(os.environ.get('VIDEO_JOBS_HISTORY', 1000))
+# Uploads are spooled here (the system temp directory by default) and removed when their job ends
+video_jobs_dir = os.environ.get('VIDEO_JOBS_DIR')
+
+class VideoJob:
+    def __init__(self, user_id, baseline_embedding, threshold, path, sampling, scoring):
+        self.job_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.path = path
+        # Keyword arguments for sample_frames and score_frames
+        self.sampling = sampling
+        self.scoring = scoring
+        self.status = 'queued'
+        # Scored frames, keyed by the order they were scored in, so partial stats are O(1) to read
+        self.frames = Session(user_id, baseline_embedding, threshold)
+        self.early_exit = False
+        self.error = None
+        self.task = None
+
+    def record(self, frame_index, timestamp, distance, faces_found):
+        self.frames.add(len(self.frames), distance)
+
+    def stats(self):
+        # (pct_present, avg_distance, std_distance) so far, or None before the first frame
+        return self.frames.stats() if len(self.frames) else None
+
+class VideoJobRunner:
+    def __init__(self, executor, config, window, max_running=video_jobs_max_running,
+                 max_pending=video_jobs_max_pending, history=video_jobs_history):
+        self.executor = executor
+        self.config = config
+        self.window = window
+        self.max_pending = max_pending
+        self.running = asyncio.Semaphore(max_running)
+        self.pending = 0
+        self.jobs = LRU(history)
+
+    def reserve(self):
+        # Claims a slot before the upload is spooled, so concurrent uploads can't overshoot
+        # max_pending; False when none is free. The slot is taken over by submit() or given back
+        # with release() if the job is never submitted
+        if self.pending >= self.max_pending:
+            return False
+        self.pending += 1
+        return True
+
+    def release(self):
+        self.pending -= 1
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def submit(self, job):
+        self.jobs[job.job_id] = job
+        job.task = asyncio.ensure_future(self.run(job))
+        # A done callback rather than a finally block, since a job cancelled while queued may never start
+        job.task.add_done_callback(lambda task: self.finished(job))
+
+    async def run(self, job):
+        try:
+            async with self.running:
+                job.status = 'running'
+                frames = sample_frames(job.path, **job.sampling)
+                # Every frame waits for a worker rather than failing the job when the pool is busy
+                _, job.early_exit = await score_frames(self.executor, frames, job.frames.baseline_embedding,
+                                                       job.frames.threshold, self.window, self.config,
+                                                       block=True, on_result=job.record, **job.scoring)
+            if len(job.frames) == 0:
+                job.status = 'failed'
+                job.error = 'No frames sampled from the video'
+            else:
+                job.status = 'done'
+        except Exception as exc:
+            job.status = 'failed'
+            job.error = str(exc)
+
+    def finished(self, job):
+        if job.task.cancelled():
+            job.status = 'cancelled'
+        self.pending -= 1
+        os.remove(job.path)
+
+    def cancel(self, job):
+        # False if the job had already finished
+        if job.task.done():
+            return False
+        job.task.cancel()
+        return True
+
+    def shutdown(self):
+        for job in self.jobs.values():
+            job.task.cancel()